@@ -0,0 +1,160 @@
+"""
+Backfill of the menu archive with the menus of past (or already published future) days.
+
+Pages are downloaded by a bounded pool of threads and parsed by a pool of processes, since
+sanitising and parsing are CPU bound. Each menu is written to the archive as soon as it is parsed,
+keyed by date and canteen, so an interrupted run can simply be started again: menus already
+archived are skipped unless --force is given.
+
+Usage:
+    python backfill.py --from 2023-01-09 --to 2023-01-13 [--canteen Petrarca --canteen Duca]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import os
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+import data_base as db
+import menu as menu_module
+from page_cache import fetch, page_cache
+
+
+load_dotenv()
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_date(text: str) -> datetime.date:
+    """
+    Parses a date in iso format, used as argparse type
+    """
+    try:
+        return datetime.date.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid date: {text}, expected YYYY-MM-DD')
+
+
+def parse_canteen(text: str) -> menu_module.Canteen:
+    """
+    Parses a canteen name, case insensitive, used as argparse type
+    """
+    for canteen in menu_module.Canteen:
+        if canteen.value.lower() == text.lower():
+            return canteen
+    raise argparse.ArgumentTypeError(f'unknown canteen: {text}')
+
+
+def get_missing(start: datetime.date, end: datetime.date, canteens: List[menu_module.Canteen],
+                force: bool) -> List[Tuple[datetime.date, menu_module.Canteen]]:
+    """
+    Gets the (date, canteen) couples still to be archived in the specified range
+    """
+    archived = set()
+    if not force:
+        cursor = db.get_archive_collection().find({'date': {'$gte': start.isoformat(), '$lte': end.isoformat()}},
+                                                  {'_id': 0, 'date': 1, 'canteen': 1})
+        archived = {(document['date'], document['canteen']) for document in cursor}
+    missing = []
+    day = start
+    while day <= end:
+        for canteen in canteens:
+            if (day.isoformat(), canteen.value.lower()) not in archived:
+                missing.append((day, canteen))
+        day += datetime.timedelta(days=1)
+    return missing
+
+
+def download(session, day: datetime.date, canteen: menu_module.Canteen, timeout: float):
+    """
+    Downloads the page of the specified day and canteen
+
+    @return: The html of the page, None if it is not available
+    """
+    page = fetch(session, menu_module.build_daily_url(day, canteen), timeout, page_cache)
+    if page.status_code != 200:
+        logger.warning("Error: %s for %s on %s", page.status_code, canteen, day)
+        return None
+    return page.body.decode('utf-8')
+
+
+def backfill(start: datetime.date, end: datetime.date, canteens: List[menu_module.Canteen],
+             fetch_workers: int, parse_processes: int, timeout: float, batch_size: int, force: bool) -> int:
+    """
+    Archives the menus of the specified canteens in the specified date range
+
+    @return: The number of menus archived
+    """
+    missing = get_missing(start, end, canteens, force)
+    logger.info("%d menus to archive", len(missing))
+    archived = 0
+    pending = []
+    with menu_module.create_session(fetch_workers) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers) as fetch_executor, \
+            concurrent.futures.ProcessPoolExecutor(max_workers=parse_processes) as parse_executor:
+        downloads = {fetch_executor.submit(download, session, day, canteen, timeout): (day, canteen)
+                     for day, canteen in missing}
+        parses = {}
+        for future in concurrent.futures.as_completed(downloads):
+            day, canteen = downloads[future]
+            try:
+                html = future.result()
+            except Exception as exception:
+                logger.error("Error: %s for %s on %s", exception, canteen, day)
+                continue
+            if html is not None:
+                parses[parse_executor.submit(menu_module.parse_menu, html)] = (day, canteen)
+        for future in concurrent.futures.as_completed(parses):
+            day, canteen = parses[future]
+            try:
+                menu, time = future.result()
+            except Exception as exception:
+                logger.error("Error: cannot parse %s on %s: %s", canteen, day, exception)
+                continue
+            if menu is None or time is None:
+                menu, time = menu_module.empty_menu(), menu_module.empty_time()
+            pending.append((day.isoformat(), canteen, menu, time))
+            if len(pending) >= batch_size:
+                menu_module.archive_menus_to_db(pending)
+                archived += len(pending)
+                pending = []
+    menu_module.archive_menus_to_db(pending)
+    archived += len(pending)
+    return archived
+
+
+def main():
+    """
+    Backfill main function
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Archive the menus of a range of days')
+    parser.add_argument('--from', dest='start', type=parse_date, required=True, help='first day, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=parse_date, required=True, help='last day, YYYY-MM-DD')
+    parser.add_argument('--canteen', dest='canteens', type=parse_canteen, action='append',
+                        help='canteen to archive, can be repeated, all of them by default')
+    parser.add_argument('--fetch-workers', type=int, default=int(os.getenv('MENU_FETCH_WORKERS', '8')),
+                        help='pages downloaded at the same time')
+    parser.add_argument('--parse-processes', type=int, default=os.cpu_count(), help='processes parsing the pages')
+    parser.add_argument('--timeout', type=float, default=float(os.getenv('MENU_FETCH_DEADLINE', '60')),
+                        help='http timeout in seconds')
+    parser.add_argument('--batch-size', type=int, default=50, help='menus written to the archive at once')
+    parser.add_argument('--force', action='store_true', help='archive again the menus already archived')
+    arguments = parser.parse_args()
+    if arguments.end < arguments.start:
+        parser.error('--to must not be before --from')
+
+    db.ensure_schema()
+    archived = backfill(arguments.start, arguments.end, arguments.canteens or list(menu_module.Canteen),
+                        arguments.fetch_workers, arguments.parse_processes, arguments.timeout,
+                        arguments.batch_size, arguments.force)
+    logger.info("Archived %d menus", archived)
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
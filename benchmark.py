@@ -0,0 +1,140 @@
+"""
+Offline benchmark and regression check of the menu parser.
+
+Every page saved in the fixtures folder is parsed stage by stage (sanitise, soup construction,
+table extraction, timetable and menu parsing), the timings and allocations of each stage are
+reported and compared against fixtures/benchmark_baseline.json, while the parsed output is
+checked against fixtures/expected.json.
+
+Usage:
+    python benchmark.py [--iterations N] [--tolerance RATIO] [--update-baseline]
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import menu
+
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE_FILE = os.path.join(FIXTURES_FOLDER, 'benchmark_baseline.json')
+EXPECTED_FILE = os.path.join(FIXTURES_FOLDER, 'expected.json')
+
+
+def run_stages(html: str) -> dict:
+    """
+    Runs the parser on the specified page one stage at a time
+
+    @return: A dictionary mapping each stage name to a (function, argument) couple,
+        in execution order, and the parsed output under the 'output' key
+    """
+    stages = {}
+    clean_html = menu.sanitise(html)
+    stages['sanitise'] = (menu.sanitise, html)
+    soup = BeautifulSoup(clean_html, 'html.parser')
+    stages['soup'] = (lambda content: BeautifulSoup(content, 'html.parser'), clean_html)
+    tables = soup.select('table#menu')
+    stages['tables'] = (lambda document: document.select('table#menu'), soup)
+    if len(tables) < 2:
+        return {'stages': stages, 'output': [None, None]}
+    stages['time_table'] = (menu.get_daily_time, tables[0])
+    stages['menu_table'] = (menu.get_daily_menu, tables[1])
+    return {'stages': stages, 'output': [menu.get_daily_menu(tables[1]), menu.get_daily_time(tables[0])]}
+
+
+def measure(function, argument, iterations: int) -> dict:
+    """
+    Measures the median duration and the peak allocation of a single stage
+    """
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function(argument)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    function(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': statistics.median(durations), 'peak_bytes': peak}
+
+
+def load_json(file_name: str) -> dict:
+    """
+    Loads a json file, an empty dictionary if it does not exist
+    """
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, encoding='utf-8') as json_file:
+        return json.load(json_file)
+
+
+def save_json(file_name: str, content: dict):
+    """
+    Saves a dictionary to a json file
+    """
+    with open(file_name, 'w', encoding='utf-8') as json_file:
+        json.dump(content, json_file, indent=2, sort_keys=True, ensure_ascii=False)
+        json_file.write('\n')
+
+
+def main():
+    """
+    Benchmark main function
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the menu parser against the saved fixtures')
+    parser.add_argument('--iterations', type=int, default=50, help='runs of each stage, the median is reported')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slowdown ratio against the baseline reported as a regression')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store the current timings and outputs as the new baseline')
+    arguments = parser.parse_args()
+
+    baseline = load_json(BASELINE_FILE)
+    expected = load_json(EXPECTED_FILE)
+    results = {}
+    outputs = {}
+    failed = False
+    for file_name in sorted(glob.glob(os.path.join(FIXTURES_FOLDER, '*.html'))):
+        fixture = os.path.splitext(os.path.basename(file_name))[0]
+        with open(file_name, encoding='utf-8') as html_file:
+            html = html_file.read()
+        run = run_stages(html)
+        outputs[fixture] = run['output']
+        results[fixture] = {stage: measure(function, argument, arguments.iterations)
+                            for stage, (function, argument) in run['stages'].items()}
+
+        print(f'{fixture}:')
+        for stage, result in results[fixture].items():
+            line = f'\t{stage:<12}{result["seconds"] * 1000:>10.3f} ms{result["peak_bytes"] / 1024:>10.1f} KiB'
+            previous = baseline.get(fixture, {}).get(stage)
+            if previous is not None and previous['seconds'] > 0:
+                ratio = result['seconds'] / previous['seconds']
+                line += f'{ratio:>8.2f}x'
+                if ratio > arguments.tolerance:
+                    line += ' REGRESSION'
+            print(line)
+        if not arguments.update_baseline:
+            if fixture not in expected:
+                print('\toutput: no expected output stored')
+            elif expected[fixture] != json.loads(json.dumps(run['output'])):
+                print('\toutput: CHANGED')
+                failed = True
+            else:
+                print('\toutput: unchanged')
+
+    if arguments.update_baseline:
+        save_json(BASELINE_FILE, results)
+        save_json(EXPECTED_FILE, outputs)
+        print('Baseline updated')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,102 @@
 """
 Telegram bot
+
+Importing this module has no side effects, the updater is built and the bot is started by main.
 """
+import time
+
+START_TIME = time.monotonic()
+
+import collections
+import html
 import os
 import datetime
 import logging
-from typing import List
+import random
+import threading
+from typing import Dict, Iterable, List, Tuple
 
-from telegram import Update, ParseMode
-from telegram.ext import Updater, CommandHandler, MessageHandler, ContextTypes, Filters
+from telegram import Bot, InlineQueryResultArticle, InputTextMessageContent, Update, ParseMode
+from telegram.ext import Updater, CommandHandler, Dispatcher, InlineQueryHandler, MessageHandler, TypeHandler, ContextTypes, Filters
+from telegram.utils.request import Request
 from dotenv import load_dotenv
+from pymongo import ReturnDocument
 
+import changes
 import data_base as db
+import dishes
+import metrics
+from broadcast import Broadcaster, Delivery, DeliveryCheckpoint
+from cache import DayTable, menu_cache, user_cache
+from concurrency import handler_pool
+from messages import pack_messages
 import menu as menu_module
+from search import dish_index
+from webhook import run_webhook
 
 load_dotenv()
 
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+USER_PROFILE_PROJECTION = {'_id': 0, 'id': 1, 'chat_id': 1, 'send_daily_updates': 1, 'canteen_list': 1, 'delivery_bucket': 1}
+
+TIME_PROJECTION = {'_id': 0, 'canteen': 1, 'date': 1, 'time': 1, 'format': 1}
+
+TURNS = {'Pranzo': 'Lunch', 'Cena': 'Dinner'}
+
+INLINE_KEYWORDS = {'menu'}
+
+inline_results = DayTable(menu_cache)
+
+
+class InstrumentedRequest(Request):
+    """
+    Request recording the duration of every call to the Telegram api
+    """
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if 'text' in data:
+            metrics.increment('telegram_messages_sent_total', method=method)
+            metrics.increment('telegram_bytes_sent_total', len(str(data['text']).encode('utf-8')), method=method)
+        with metrics.timed('telegram_request_seconds', method=method):
+            return super().post(url, data, timeout=timeout)
+
 
-updater = Updater(token=os.getenv('TELEGRAM_BOT_TOKEN'), use_context=True)
-dispatcher = updater.dispatcher
+def create_updater() -> Updater:
+    """
+    Build the updater with its bot and dispatcher, no request is sent to Telegram
+
+    The Bot API is reached at TELEGRAM_BASE_URL, which the load test points to a local fake server.
+    """
+    workers = int(os.getenv('BOT_WORKERS', '4'))
+    # the handler pool workers and the broadcast senders share the same connection pool,
+    # the daily broadcast and a change push can run at the same time, each with its own senders
+    broadcast_workers = int(os.getenv('BROADCAST_WORKERS', '8'))
+    request = InstrumentedRequest(con_pool_size=workers + handler_pool.workers + 2 * broadcast_workers + 4)
+    bot = Bot(token=os.getenv('TELEGRAM_BOT_TOKEN'), base_url=os.getenv('TELEGRAM_BASE_URL', 'https://api.telegram.org/bot'),
+              request=request)
+    return Updater(bot=bot, use_context=True, workers=workers)
+
+
+def packing_enabled() -> bool:
+    """
+    Whether the rendered blocks are packed into as few messages as possible, set by PACK_MESSAGES
+    """
+    return os.getenv('PACK_MESSAGES', 'true').lower() == 'true'
+
+
+def reply_messages(update: Update, blocks: List[str], packed: bool = None):
+    """
+    Reply with the rendered blocks
+
+    @param packed: If True the blocks are packed into as few messages as possible, otherwise
+        each block is sent as its own message, defaults to the PACK_MESSAGES environment variable
+    """
+    if packed is None:
+        packed = packing_enabled()
+    for msg in pack_messages(blocks) if packed else blocks:
+        update.message.reply_text(text=msg, parse_mode=ParseMode.HTML)
 
 
 def save_user(update: Update, _: ContextTypes):
@@ -29,37 +104,52 @@ def save_user(update: Update, _: ContextTypes):
     Save user to database
     """
     logger.info("Adding user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    if collection.count_documents({'id': update.effective_user.id}) == 0:
-        collection.insert_one({
-            'id': update.effective_user.id,
+    collection = db.get_user_collection()
+    result = collection.update_one({'id': update.effective_user.id}, {
+        '$setOnInsert': {
             'first_name': update.effective_user.first_name,
             'last_name': update.effective_user.last_name,
             'username': update.effective_user.username,
             'chat_id': update.effective_chat.id,
             'send_daily_updates': False,
             'canteen_list': []
-        })
+        },
+        '$set': {'active': True}
+    }, upsert=True)
+    user_cache.invalidate(update.effective_user.id)
+    if result.upserted_id is not None:
         update.message.reply_text(f'Hello, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
     else:
         update.message.reply_text(f'Hello again, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
     logger.info("Added user: %s", update.effective_user.username)
-    db.close_connection(mongo_client)
 
 
 def subscribe(update: Update, _: ContextTypes):
     """
-    Subscribe user to daily updates
+    Subscribe user to daily updates, at the HH:MM time following the command or at the default one
+
+    Already subscribed users only change their delivery time, when one is given, and keep their favourite canteens.
     """
     logger.info("Subscribing user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    collection.update_one({'id':update.effective_user.id}, {'$set': {'send_daily_updates': True, 'canteen_list': []}})
-    update.message.reply_text(f'You have been subscribed to daily updates, {update.effective_user.first_name}!\nPlease save your favourite canteen(s) to receive daily updates.\nTo do so, send /save_canteen_to_favourite followed by the names of your favourite canteens.', parse_mode=ParseMode.HTML)
-    db.close_connection(mongo_client)
+    msg_content = update.message.text.split()[1:]
+    try:
+        bucket = get_delivery_bucket(msg_content[0] if len(msg_content) > 0 else os.getenv('DEFAULT_DELIVERY_TIME', '09:00'))
+    except ValueError:
+        update.message.reply_text('Please specify the delivery time as HH:MM, for example: /subscribe 11:30', parse_mode=ParseMode.HTML)
+        return
+    profile = get_user_profile(update.effective_user.id)
+    if profile is not None and profile.get('send_daily_updates', False):
+        if len(msg_content) <= 0:
+            # no time given, the chosen slot is kept
+            bucket = profile.get('delivery_bucket', bucket)
+            update.message.reply_text(f'You are already subscribed to daily updates at {get_delivery_time_string(bucket)}, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
+            return
+        update_user_profile(update.effective_user.id, {'$set': {'delivery_bucket': bucket}})
+        update.message.reply_text(f'You will receive daily updates at {get_delivery_time_string(bucket)}, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
+        logger.info("Changed delivery time of user: %s", update.effective_user.username)
+        return
+    update_user_profile(update.effective_user.id, {'$set': {'send_daily_updates': True, 'canteen_list': [], 'delivery_bucket': bucket}})
+    update.message.reply_text(f'You have been subscribed to daily updates at {get_delivery_time_string(bucket)}, {update.effective_user.first_name}!\nPlease save your favourite canteen(s) to receive daily updates.\nTo do so, send /save_canteen_to_favourite followed by the names of your favourite canteens.', parse_mode=ParseMode.HTML)
     logger.info("Subscribed user: %s", update.effective_user.username)
 
 
@@ -68,12 +158,8 @@ def unsubscribe(update: Update, _: ContextTypes):
     Unsubscribe user from daily updates
     """
     logger.info("Unsubscribing user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    collection.update_one({'id':update.effective_user.id}, {'$set': {'send_daily_updates': False, 'canteen_list': []}})
+    update_user_profile(update.effective_user.id, {'$set': {'send_daily_updates': False, 'canteen_list': []}})
     update.message.reply_text(f'You have been unsubscribed from daily updates, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
-    db.close_connection(mongo_client)
     logger.info("Unsubscribed user: %s", update.effective_user.username)
 
 
@@ -82,28 +168,31 @@ def delete_user(update: Update, _: ContextTypes):
     Delete user from database
     """
     logger.info("Deleting user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
+    collection = db.get_user_collection()
     collection.delete_one({'id': update.effective_user.id})
+    user_cache.invalidate(update.effective_user.id)
     update.message.reply_text(f'Goodbye, {update.effective_user.first_name}!', parse_mode=ParseMode.HTML)
-    db.close_connection(mongo_client)
     logger.info("Deleted user: %s", update.effective_user.username)
 
 
-def get_today_menu():
+def get_today_menu(refresh: bool = True):
     """
     Get today's menu from database
+
+    @param refresh: If False a missing menu is not refreshed, the last saved one is returned instead
     """
     logger.info("Getting today menu")
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_MENU_COLLECTION')]
-    menu = list(collection.find({'date': datetime.date.today().isoformat()}))
-    db.close_connection(mongo_client)
+    today = datetime.date.today().isoformat()
+    menu = get_canteens(date=today)
+    if len(menu) == 0 and refresh and menu_module.refresh_menu(force=True):
+        menu = get_canteens(date=today)
     if len(menu) == 0:
-        menu_module.init_menu()
-        menu = get_today_menu()
+        logger.info("Today menu is not available, falling back to the last saved one")
+        menu = dishes.decode_documents(db.get_menu_collection().find({}))
+        for item in menu:
+            item['stale'] = True
+        return menu
+    menu_module.menu_readiness.set(today)
     logger.info("Got today menu")
     return menu
 
@@ -115,31 +204,51 @@ def get_today_menu_string(menu = None, canteen_names: List[str] = None) -> List[
     logger.info("Getting today menu string")
     if menu is None:
         menu = get_today_menu()
-    if canteen_names is not None and len(canteen_names) > 0:
-        menu = filter(lambda x: x['canteen'].lower() in [x.lower() for x in canteen_names], menu)
+    text = get_menu_messages({item['canteen']: get_canteen_menu_string(item) for item in menu}, canteen_names)
+    logger.info("Got today menu string")
+    return text
+
+
+def get_canteen_menu_string(item: dict) -> str:
+    """
+    Get the menu of a single canteen as a string
+    """
+    tmp_text = f' Canteen <b>{item["canteen"].title()}</b>:\n'
+    if item.get('stale', False):
+        tmp_text += f'\t<i>Today\'s menu is not available yet, this is the menu of {item["date"]}</i>\n'
+    if item['time']['Pranzo']['IsOpen']:
+        tmp_text += '\t<b>Lunch</b>:\n'
+        for course in item["menu"]["Pranzo"]:
+            tmp_text += f'\t\t<b>{course.title()}</b>:\n'
+            for plate in item['menu']['Pranzo'][course]:
+                tmp_text += f'\t\t\t{plate.title()}\n'
+    else:
+        tmp_text += '\t<b>Lunch</b>: Closed\n'
+    if item['time']['Cena']['IsOpen']:
+        tmp_text += '\t<b>Dinner</b>:\n'
+        for course in item["menu"]["Cena"]:
+            tmp_text += f'\t\t<b>{course}</b>:\n'
+            for plate in item['menu']['Cena'][course]:
+                tmp_text += f'\t\t\t{plate.title()}\n'
+    else:
+        tmp_text += '\tDinner: Closed\n'
+    return tmp_text
+
+
+def get_menu_messages(canteen_menus: Dict[str, str], canteen_names: Iterable[str] = None) -> List[str]:
+    """
+    Get the messages containing the already rendered menus of the specified canteens
+
+    @param canteen_menus: The rendered menu of each canteen, keyed by canteen name
+    @param canteen_names: The canteens to include, all of them if empty
+    """
+    canteen_names = {name.lower() for name in canteen_names} if canteen_names is not None else set()
     text = ['Today\'s menu:\n']
-    for item in menu:
-        tmp_text = f' Canteen <b>{item["canteen"].title()}</b>:\n'
-        if item['time']['Pranzo']['IsOpen']:
-            tmp_text += '\t<b>Lunch</b>:\n'
-            for course in item["menu"]["Pranzo"]:
-                tmp_text += f'\t\t<b>{course.title()}</b>:\n'
-                for plate in item['menu']['Pranzo'][course]:
-                    tmp_text += f'\t\t\t{plate.title()}\n'
-        else:
-            tmp_text += '\t<b>Lunch</b>: Closed\n'
-        if item['time']['Cena']['IsOpen']:
-            tmp_text += '\t<b>Dinner</b>:\n'
-            for course in item["menu"]["Cena"]:
-                tmp_text += f'\t\t<b>{course}</b>:\n'
-                for plate in item['menu']['Cena'][course]:
-                    tmp_text += f'\t\t\t{plate.title()}\n'
-        else:
-            tmp_text += '\tDinner: Closed\n'
-        text.append(tmp_text)
+    for canteen, canteen_menu in canteen_menus.items():
+        if len(canteen_names) <= 0 or canteen.lower() in canteen_names:
+            text.append(canteen_menu)
     if len(text) <= 1:
         text = ['No menu available for the specified canteens']
-    logger.info("Got today menu string")
     return text
 
 
@@ -150,38 +259,373 @@ def today_menu(update: Update, _: ContextTypes):
     logger.info("Sending today menu to user: %s", update.effective_user.username)
     msg_content = update.message.text.split(' ')
     text = get_today_menu_string(canteen_names=msg_content[1:])
-    for msg in text:
-        update.message.reply_text(text=msg, parse_mode=ParseMode.HTML)
+    reply_messages(update, text)
     logger.info("Sent today menu to user: %s", update.effective_user.username)
 
 
-def send_daily_updates(context: ContextTypes):
+def get_canteen_turn_string(item: dict, turn: str) -> str:
+    """
+    Get the menu of a single turn of a canteen as a string
+    """
+    tmp_text = f'Canteen <b>{item["canteen"].title()}</b>, <b>{TURNS[turn]}</b>:\n'
+    if item.get('stale', False):
+        tmp_text += f'\t<i>Today\'s menu is not available yet, this is the menu of {item["date"]}</i>\n'
+    if not item['time'][turn]['IsOpen']:
+        return tmp_text + '\tClosed\n'
+    tmp_text += f'\t{item["time"][turn]["OpenTime"]} - {item["time"][turn]["CloseTime"]}\n'
+    for course in item['menu'][turn]:
+        tmp_text += f'\t<b>{course.title()}</b>:\n'
+        for plate in item['menu'][turn][course]:
+            tmp_text += f'\t\t{plate.title()}\n'
+    return tmp_text
+
+
+def build_inline_results() -> Dict[str, List[Tuple[str, InlineQueryResultArticle]]]:
+    """
+    Render the inline results of today, one per canteen and turn
+
+    @return: The (turn name, result) couples, keyed by canteen name
+    """
+    logger.info("Building inline results")
+    results = {}
+    for item in sorted(get_today_menu(), key=lambda item: item['canteen']):
+        results[item['canteen']] = []
+        for turn, turn_name in TURNS.items():
+            if item['time'][turn]['IsOpen']:
+                description = ', '.join(plate.title() for plates in item['menu'][turn].values() for plate in plates[:1])
+            else:
+                description = 'Closed'
+            results[item['canteen']].append((turn_name.lower(), InlineQueryResultArticle(
+                id=f'{item["canteen"]}-{turn}',
+                title=f'{item["canteen"].title()} - {turn_name}',
+                description=description,
+                input_message_content=InputTextMessageContent(get_canteen_turn_string(item, turn), parse_mode=ParseMode.HTML))))
+    return results
+
+
+def inline_menu(update: Update, _: ContextTypes):
+    """
+    Answer an inline query, for example "@bot menu petrarca dinner", with the precomputed results of today
+
+    Canteens are matched by prefix, the optional turn filters lunch or dinner.
+    """
+    words = [word for word in update.inline_query.query.lower().split() if word not in INLINE_KEYWORDS]
+    prefix = words[0] if len(words) > 0 else ''
+    turn_filter = words[1] if len(words) > 1 else ''
+    table = inline_results.get(datetime.date.today().isoformat(), build_inline_results)
+    results = []
+    for canteen, canteen_results in table.items():
+        if not canteen.startswith(prefix):
+            continue
+        results.extend(result for turn_name, result in canteen_results if turn_name.startswith(turn_filter))
+    update.inline_query.answer(results[:50], cache_time=int(os.getenv('INLINE_CACHE_TIME', '300')), is_personal=False)
+
+
+def blocked_handler(checkpoint: DeliveryCheckpoint):
+    """
+    Get the callback of a broadcast recording the users who blocked the bot and dropping their cached profile
+    """
+    def on_blocked(delivery: Delivery):
+        checkpoint.blocked(delivery)
+        user_cache.invalidate(delivery.user_id)
+    return on_blocked
+
+
+def send_daily_updates(context: ContextTypes, buckets: Tuple[int, int] = None):
     """
     Send daily updates to users
+
+    Users already served today are skipped, so a run interrupted by a crash resumes where it stopped.
+
+    @param buckets: The first and last delivery bucket to serve, all the subscribers if None
+    @return: The stats of the broadcast
     """
+    today = datetime.date.today().isoformat()
+    query = {'send_daily_updates': True, 'last_daily_update': {'$ne': today}}
+    if buckets is not None:
+        query['delivery_bucket'] = {'$gte': buckets[0], '$lte': buckets[1]}
+    collection = db.get_user_collection()
+    users = list(collection.find(query, {'id': 1, 'chat_id': 1, 'canteen_list': 1}))
+    if len(users) <= 0:
+        return {}
     logger.info('Start sending daily updates')
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    users = list(collection.find({'send_daily_updates': True}))
-    db.close_connection(mongo_client)
+    if not menu_module.menu_readiness.wait(today, 0) and len(get_canteens(date=today)) <= 0:
+        # slots earlier than the scheduled pre-warm get the menu themselves, a refresh already running is joined
+        logger.info('Refreshing today menu before the daily updates')
+        if not menu_module.refresh_menu(timeout=float(os.getenv('MENU_READY_WAIT', '300'))):
+            logger.warning('Today menu is not available, sending the last saved one')
+    # each canteen is rendered once, then users sharing the same favourites share the same messages,
+    # a missing menu falls back to the last saved one
+    canteen_menus = {item['canteen']: get_canteen_menu_string(item) for item in get_today_menu(refresh=False)}
+    users_by_favourites = collections.defaultdict(list)
+    for user in users:
+        users_by_favourites[frozenset(canteen.lower() for canteen in user['canteen_list'])].append(user)
+    deliveries = []
+    for favourites, favourite_users in users_by_favourites.items():
+        messages = get_menu_messages(canteen_menus, favourites)
+        if packing_enabled():
+            messages = pack_messages(messages)
+        deliveries.extend(Delivery(user['id'], user['chat_id'], messages) for user in favourite_users)
+    checkpoint = DeliveryCheckpoint(collection, 'last_daily_update', today)
+    try:
+        stats = Broadcaster(context.bot).run(deliveries, on_delivered=checkpoint.delivered, on_blocked=blocked_handler(checkpoint))
+    finally:
+        checkpoint.flush()
+    logger.info('Completed sending daily updates to %d users, %d distinct favourites, in %.1f seconds (%.1f messages/s): %s',
+                len(deliveries), len(users_by_favourites), stats['seconds'], stats['messages_per_second'], stats)
+    logger.info('Menu cache stats: %s', menu_cache.stats())
+    return stats
+
+
+def get_search_string(query: str, entries: list, limit: int) -> List[str]:
+    """
+    Get the search results as a string, the next days first and then the most recent ones
+
+    @param query: The searched text
+    @param entries: The entries found in the dish index
+    @param limit: The maximum number of entries shown
+    """
+    today = datetime.date.today().isoformat()
+    upcoming = [entry for entry in entries if entry.date >= today]
+    past = [entry for entry in reversed(entries) if entry.date < today]
+    entries = upcoming + past
+    if len(entries) <= 0:
+        return [f'No dish found for <b>{html.escape(query)}</b>']
+    text = f'Results for <b>{html.escape(query)}</b>:\n'
+    for entry in entries[:limit]:
+        text += f'\t{entry.date} <b>{entry.canteen.title()}</b>, {TURNS.get(entry.turn, entry.turn)}, {entry.course.title()}: {entry.dish.title()}\n'
+    if len(entries) > limit:
+        text += f'\tand {len(entries) - limit} more\n'
+    return [text]
+
+
+def search_dish(update: Update, _: ContextTypes):
+    """
+    Send the days and canteens serving the searched dish
+    """
+    logger.info("Searching dish for user: %s", update.effective_user.username)
+    query = ' '.join(update.message.text.split(' ')[1:]).strip()
+    if len(query) <= 0:
+        update.message.reply_text('Please specify the dish to search, for example: /search lasagne', parse_mode=ParseMode.HTML)
+        return
+    if not dish_index.loaded.wait(timeout=float(os.getenv('SEARCH_LOAD_WAIT', '5'))):
+        logger.warning("Dish index is still loading, results may be incomplete")
+    text = get_search_string(query, dish_index.search(query), int(os.getenv('SEARCH_RESULTS', '10')))
+    reply_messages(update, text)
+    logger.info("Searched dish for user: %s", update.effective_user.username)
+
+
+def load_dish_index():
+    """
+    Index the dishes of the archived menus
+    """
+    try:
+        dishes.dish_dictionary.load()
+        cursor = db.get_archive_collection().find({}, {'_id': 0, 'date': 1, 'canteen': 1, 'menu': 1, 'format': 1})
+        dish_index.load(dishes.decode_documents([document])[0] for document in cursor)
+    except Exception as exception:
+        logger.error("Cannot load the dish index: %s", exception)
+        dish_index.loaded.set()
+
+
+def get_user_profile(user_id: int) -> dict:
+    """
+    Get the profile of the user from the cache, or from the database on a miss
+
+    @return: The profile, None if the user is not registered
+    """
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        return profile
+    profile = db.get_user_collection().find_one({'id': user_id}, USER_PROFILE_PROJECTION)
+    if profile is not None:
+        user_cache.put(user_id, profile)
+    return profile
+
+
+def update_user_profile(user_id: int, changes: dict) -> dict:
+    """
+    Atomically update the profile of the user in the database, then store the updated profile in the cache
+
+    @param changes: The update operators to apply
+    @return: The updated profile, None if the user is not registered
+    """
+    profile = db.get_user_collection().find_one_and_update({'id': user_id}, changes, projection=USER_PROFILE_PROJECTION,
+                                                           return_document=ReturnDocument.AFTER)
+    if profile is None:
+        user_cache.invalidate(user_id)
+    else:
+        user_cache.put(user_id, profile)
+    return profile
+
+
+def get_delivery_bucket(delivery_time: str) -> int:
+    """
+    Get the delivery bucket of a HH:MM time, the minute of the day
+
+    @raise ValueError: If the time is not valid
+    """
+    parsed = datetime.datetime.strptime(delivery_time.strip(), '%H:%M')
+    return parsed.hour * 60 + parsed.minute
+
+
+def get_delivery_time_string(bucket: int) -> str:
+    """
+    Get the HH:MM time of a delivery bucket
+    """
+    return f'{bucket // 60:02d}:{bucket % 60:02d}'
+
+
+def get_current_bucket() -> int:
+    """
+    Get the delivery bucket of the current minute, in the time users choose their slot in
+
+    DELIVERY_TIME_OFFSET is the number of minutes to add to the server clock to get that time.
+    """
+    now = datetime.datetime.now() + datetime.timedelta(minutes=int(os.getenv('DELIVERY_TIME_OFFSET', '60')))
+    return now.hour * 60 + now.minute
+
+
+def assign_default_delivery_bucket():
+    """
+    Give the default delivery slot to the subscribers saved before delivery slots existed
+    """
+    result = db.get_user_collection().update_many(
+        {'send_daily_updates': True, 'delivery_bucket': {'$exists': False}},
+        {'$set': {'delivery_bucket': get_delivery_bucket(os.getenv('DEFAULT_DELIVERY_TIME', '09:00'))}})
+    if result.modified_count > 0:
+        logger.info("Assigned the default delivery slot to %d subscribers", result.modified_count)
+
+
+last_delivered_bucket = None
+
+
+def delivery_tick(context: ContextTypes):
+    """
+    Send the daily updates of the users whose delivery slot is due
+
+    Every run serves the buckets from the one after the last served up to the current one, so
+    slots are not skipped when runs are late or skipped while a long broadcast is running.
+    The first run after a start serves every bucket of the day up to the current one, the users
+    already served today are skipped, so the slots missed during a crash are resumed.
+    """
+    global last_delivered_bucket
+    current = get_current_bucket()
+    if last_delivered_bucket is None or last_delivered_bucket > current:
+        # first run or the day changed, every bucket of the day so far is served
+        first = 0
+    elif last_delivered_bucket == current:
+        return
+    else:
+        first = last_delivered_bucket + 1
+    send_daily_updates(context, buckets=(first, current))
+    last_delivered_bucket = current
+
+
+def parse_schedule(schedule: str) -> List[datetime.time]:
+    """
+    Parse a comma separated list of HH:MM times
+    """
+    return [datetime.datetime.strptime(item.strip(), '%H:%M').time() for item in schedule.split(',') if item.strip() != '']
+
+
+def refresh_menu_job(_: ContextTypes):
+    """
+    Refresh today's menu ahead of the users, pages which did not change are not parsed again
+    """
+    logger.info("Running scheduled menu refresh")
+    if menu_module.refresh_menu():
+        logger.info("Scheduled menu refresh completed")
+    else:
+        logger.warning("Scheduled menu refresh failed")
+
+
+def start_menu_job(context: ContextTypes):
+    """
+    Bring today's menu up at start, when MENU_OFFLINE_START is set it is first rebuilt from the page cache,
+    so the bot can answer even if ERDIS cannot be reached, then it is refreshed as usual
+    """
+    if os.getenv('MENU_OFFLINE_START', 'false').lower() == 'true':
+        logger.info("Rebuilding today menu from the page cache")
+        logger.info("Rebuilt the menu of %d canteens from the page cache", menu_module.rebuild_menu_from_cache())
+    refresh_menu_job(context)
+
+
+def schedule_refresh_job(context: ContextTypes):
+    """
+    Run the menu refresh after a random delay, so that many bot processes do not hit ERDIS at the same time
+    """
+    context.job_queue.run_once(refresh_menu_job, random.uniform(0, float(os.getenv('MENU_REFRESH_JITTER', '120'))))
+
+
+def schedule_menu_refresh(job_queue):
+    """
+    Schedule the menu refreshes: one right after the start, see start_menu_job, then every day at the times of MENU_REFRESH_SCHEDULE
+
+    The first time of the schedule pre-warms the menu before the daily updates, the others check
+    for changes through lunch.
+    """
+    job_queue.run_once(start_menu_job, 0)
+    for refresh_time in parse_schedule(os.getenv('MENU_REFRESH_SCHEDULE', '07:30,09:00,10:00,11:00,11:30,12:00,12:30,13:00')):
+        job_queue.run_daily(schedule_refresh_job, time=refresh_time)
+
+
+def get_menu_change_string(change: changes.MenuChange) -> str:
+    """
+    Get the changes of the menu of a canteen as a compact string
+    """
+    tmp_text = f'The menu of <b>{change.canteen.title()}</b> has been updated:\n'
+    for turn, turn_changes in change.diff.items():
+        tmp_text += f'\t<b>{TURNS.get(turn, turn)}</b>:'
+        if turn_changes.get('closed', False):
+            tmp_text += ' Closed\n'
+            continue
+        if turn_changes.get('reopened', False):
+            tmp_text += ' Open'
+        if 'hours' in turn_changes:
+            tmp_text += f' {turn_changes["hours"]}'
+        tmp_text += '\n'
+        for course in dict.fromkeys(list(turn_changes.get('added', {})) + list(turn_changes.get('removed', {}))):
+            plates = [f'+ {plate.title()}' for plate in turn_changes.get('added', {}).get(course, [])]
+            plates += [f'- {plate.title()}' for plate in turn_changes.get('removed', {}).get(course, [])]
+            tmp_text += f'\t\t<b>{course.title()}</b>: {", ".join(plates)}\n'
+    return tmp_text
+
+
+def push_menu_changes(context: ContextTypes):
+    """
+    Send the changes of the menus to the subscribers having the changed canteens among their favourites
+    and who already received today's menu
+
+    The changes are passed as the context of the job.
+    """
+    menu_changes = context.job.context
+    logger.info('Start sending menu changes of %s', [change.canteen for change in menu_changes])
+    texts = {change.canteen: get_menu_change_string(change) for change in menu_changes}
+    collection = db.get_user_collection()
+    # users whose daily update is still to come will get the changed menu with it
+    users = collection.find({'send_daily_updates': True, 'canteen_list': {'$in': list(texts)},
+                             'last_daily_update': menu_changes[0].date},
+                            {'id': 1, 'chat_id': 1, 'canteen_list': 1})
+    deliveries = []
     for user in users:
-        menu = get_today_menu_string(canteen_names=user['canteen_list'])
-        for msg in menu:
-            context.bot.send_message(chat_id=user['chat_id'], text=msg, parse_mode=ParseMode.HTML)
-    logger.info('Completed sending daily updates')
+        blocks = [text for canteen, text in texts.items() if canteen in user['canteen_list']]
+        deliveries.append(Delivery(user['id'], user['chat_id'], pack_messages(blocks)))
+    # a change push is not resumed after a crash, only the users who blocked the bot are recorded
+    checkpoint = DeliveryCheckpoint(collection)
+    try:
+        stats = Broadcaster(context.bot).run(deliveries, on_blocked=blocked_handler(checkpoint))
+    finally:
+        checkpoint.flush()
+    logger.info('Completed sending menu changes to %d users: %s', len(deliveries), stats)
 
 
 def get_user_canteen_list_from_db(user_id):
     """
-    Get user's canteen list from database
+    Get user's canteen list, from the cache when possible
     """
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    user = collection.find_one({'id': user_id})
-    db.close_connection(mongo_client)
-    return user["canteen_list"]
+    profile = get_user_profile(user_id)
+    return profile["canteen_list"] if profile is not None else []
 
 
 def get_user_canteen_list(update: Update, _: ContextTypes):
@@ -210,23 +654,18 @@ def add_canteen_to_user_list(update: Update, _: ContextTypes):
     Add canteen to user's canteen list
     """
     logger.info("Adding canteen list to user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    user = collection.find_one({'id': update.effective_user.id})
-    canteen_list = user['canteen_list']
     msg_content = update.message.text.split(' ')
     msg_content = list(filter(lambda x: x.lower() in [canteen.value.lower() for canteen in menu_module.Canteen], [x.lower() for x in msg_content[1:]]))
-    canteens_to_add = list(set(msg_content) - set(canteen_list))
+    canteens_to_add = list(dict.fromkeys(msg_content))
     if len(canteens_to_add) <= 0:
         update.message.reply_text('No canteens added, please specify at least one', parse_mode=ParseMode.HTML)
-        db.close_connection(mongo_client)
         logger.info("No canteens added to user: %s", update.effective_user.username)
         return
-    canteen_list.extend(canteens_to_add)
-    collection.update_one({'id': update.effective_user.id}, {'$set': {'canteen_list': canteen_list}})
-    db.close_connection(mongo_client)
-    update.message.reply_text(get_canteen_list_string(canteen_list), parse_mode=ParseMode.HTML)
+    profile = update_user_profile(update.effective_user.id, {'$addToSet': {'canteen_list': {'$each': canteens_to_add}}})
+    if profile is None:
+        update.message.reply_text('Please send /start first', parse_mode=ParseMode.HTML)
+        return
+    update.message.reply_text(get_canteen_list_string(profile['canteen_list']), parse_mode=ParseMode.HTML)
     logger.info("Added canteen list to user: %s", update.effective_user.username)
 
 
@@ -235,34 +674,52 @@ def remove_canteen_from_user_list(update: Update, _: ContextTypes):
     Remove canteen from user's canteen list
     """
     logger.info("Removing canteen list from user: %s", update.effective_user.username)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_USER_COLLECTION')]
-    user = collection.find_one({'id': update.effective_user.id})
-    canteen_list = user['canteen_list']
     msg_content = update.message.text.split(' ')[1:]
     if len(msg_content) <= 0:
         update.message.reply_text('No canteens removed, specify at least one canteen to remove', parse_mode=ParseMode.HTML)
         return
-    canteen_list = list(filter(lambda x: x.lower() not in [canteen.lower() for canteen in msg_content], canteen_list))
-    collection.update_one({'id': update.effective_user.id}, {'$set': {'canteen_list': canteen_list}})
-    db.close_connection(mongo_client)
-    update.message.reply_text(get_canteen_list_string(canteen_list), parse_mode=ParseMode.HTML)
+    profile = update_user_profile(update.effective_user.id,
+                                  {'$pull': {'canteen_list': {'$in': [canteen.lower() for canteen in msg_content]}}})
+    if profile is None:
+        update.message.reply_text('Please send /start first', parse_mode=ParseMode.HTML)
+        return
+    update.message.reply_text(get_canteen_list_string(profile['canteen_list']), parse_mode=ParseMode.HTML)
     logger.info("Removed canteen list from user: %s", update.effective_user.username)
 
 
-def get_canteen(canteen_name: str) -> dict:
+def get_canteens(canteen_names: Iterable[str] = None, date: str = None, projection: dict = None) -> List[dict]:
+    """
+    Get the menu documents of many canteens for a day, from the menu cache or with a single query
+
+    @param canteen_names: The canteens to get, all of them if None
+    @param date: The day in iso format, today if None
+    @param projection: The fields the caller needs, all of them if None
+    @return: The documents found, in the order of canteen_names
+    """
+    if date is None:
+        date = datetime.date.today().isoformat()
+    names = list(dict.fromkeys(name.lower() for name in canteen_names)) if canteen_names is not None else None
+    documents = menu_cache.get_day(date)
+    if documents is None:
+        query = {'date': date}
+        if names is not None:
+            query['canteen'] = {'$in': names}
+        documents = dishes.decode_documents(db.get_menu_collection().find(query, projection))
+        # only complete documents of every canteen can fill the cache
+        if names is None and projection is None and len(documents) > 0:
+            menu_cache.put_day(date, documents)
+    if names is None:
+        return documents
+    by_canteen = {document['canteen']: document for document in documents}
+    return [by_canteen[name] for name in names if name in by_canteen]
+
+
+def get_canteen(canteen_name: str, date: str = None) -> dict:
     """
     Get canteen from database
     """
-    logger.info("Getting from database canteen: %s", canteen_name)
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client)
-    collection = data_base[os.getenv('DB_MENU_COLLECTION')]
-    canteen = collection.find_one({'canteen': canteen_name.lower()})
-    db.close_connection(mongo_client)
-    logger.info("Got from database canteen: %s", canteen)
-    return canteen
+    canteens = get_canteens([canteen_name], date)
+    return canteens[0] if len(canteens) > 0 else None
 
 
 def get_today_time_string(canteen_names: List[str] = None) -> str:
@@ -273,12 +730,15 @@ def get_today_time_string(canteen_names: List[str] = None) -> str:
     if canteen_names is None or len(canteen_names)<=0:
         text = "Since no canteen has been specified, here you have the full list\n"
         canteen_names = [canteen.value for canteen in menu_module.Canteen]
+    names = [name.lower() for name in canteen_names if name.lower() in [canteen.value.lower() for canteen in menu_module.Canteen]]
+    canteens = get_canteens(names, projection=TIME_PROJECTION) if len(names) > 0 else []
+    if len(names) > 0 and len(canteens) <= 0:
+        canteens = [item for item in get_today_menu() if item['canteen'] in names]
     text = []
-    for canteen in canteen_names:
-        canteen = get_canteen(canteen)
-        if canteen is None:
-            continue
+    for canteen in canteens:
         tmp_text = f'Canteen <b>{canteen["canteen"].title()}</b>:\n'
+        if canteen.get('stale', False):
+            tmp_text += f'\t<i>Today\'s time is not available yet, this is the time of {canteen["date"]}</i>\n'
         if canteen['time']['Pranzo']['IsOpen']:
             tmp_text += f'\t<b>Lunch</b>: {canteen["time"]["Pranzo"]["OpenTime"]} - {canteen["time"]["Pranzo"]["CloseTime"]}\n'
         else:
@@ -302,8 +762,7 @@ def canteen_time(update: Update, _: ContextTypes):
     except AttributeError:
         return
     text = get_today_time_string(msg_content[1:])
-    for msg in text:
-        update.message.reply_text(text=msg, parse_mode=ParseMode.HTML)
+    reply_messages(update, text)
     logger.info("Got canteen time for user: %s", update.effective_user.username)
 
 
@@ -314,8 +773,7 @@ def my_canteens_menu(update: Update, _: ContextTypes):
     logger.info("Getting favourite canteens menu for user: %s", update.effective_user.username)
     canteen_list = get_user_canteen_list_from_db(update.effective_user.id)
     text = get_today_menu_string(canteen_names=canteen_list)
-    for msg in text:
-        update.message.reply_text(text=msg, parse_mode=ParseMode.HTML)
+    reply_messages(update, text)
     logger.info("Got favourite canteens menu for user: %s", update.effective_user.username)
 
 
@@ -326,8 +784,7 @@ def my_canteens_time(update: Update, _: ContextTypes):
     logger.info("Getting favourite canteens time for user: %s", update.effective_user.username)
     canteen_list = get_user_canteen_list_from_db(update.effective_user.id)
     text = get_today_time_string(canteen_names=canteen_list)
-    for msg in text:
-        update.message.reply_text(text=msg, parse_mode=ParseMode.HTML)
+    reply_messages(update, text)
     logger.info("Got favourite canteens time for user: %s", update.effective_user.username)
 
 
@@ -366,7 +823,7 @@ def bot_help(update: Update, _: ContextTypes):
     logger.info("Sending help to user: %s", update.effective_user.username)
     text = 'Help:\n'
     text += '/start - Start the bot\n'
-    text += '/subscribe - Subscribe to daily updates\n'
+    text += '/subscribe - Subscribe to daily updates, optionally at the specified HH:MM time\n'
     text += '/unsubscribe - Unsubscribe from daily updates\n'
     text += '/stop - Stop the bot\n'
     text += '/menu - Get today\'s menu for the specified canteen(s)\n'
@@ -377,6 +834,8 @@ def bot_help(update: Update, _: ContextTypes):
     text += '/favourite_canteen_menu - Get your canteen(s) daily menu\n'
     text += '/favourite_canteen_time - Get your canteen(s) time\n'
     text += '/available_canteen_list - Get the names of available canteens\n'
+    text += '/search - Get the days and canteens serving the specified dish\n'
+    text += '@ followed by the bot name, a canteen and optionally lunch or dinner - Share a menu in any chat\n'
     text += '/credits - Get credits\n'
     text += '/help - Shows this message\n'
     text += '/restart - Updates the bot source code from the related github branch, then restarts it'
@@ -385,8 +844,12 @@ def bot_help(update: Update, _: ContextTypes):
     text += '\t\t/menu canteen1 canteen2\n'
     text += '\tThe following command will add canteen1 and canteen2 to your favourite canteens list, so you will receive daily updates also for those two:\n'
     text += '\t\t/save_canteen_to_favourite canteen1 canteen2\n'
+    text += '\tThe following command will send you the daily updates at 11:30:\n'
+    text += '\t\t/subscribe 11:30\n'
     text += '\tThe following command will show canteen1 and canteen2 open and close time for lunch and dinner:\n'
     text += '\t\t/canteen_time canteen1 canteen2\n'
+    text += '\tThe following command will show when and where lasagne is served:\n'
+    text += '\t\t/search lasagne\n'
 
     update.message.reply_text(text, parse_mode=ParseMode.HTML)
     logger.info("Sent help to user: %s", update.effective_user.username)
@@ -412,27 +875,89 @@ def restart(update: Update, _: ContextTypes):
   os.kill(os.getpid(), signal.SIGINT)
 
 
-def set_handlers():
+def bot_stats(update: Update, _: ContextTypes):
+    """
+    Send the latency percentiles of the bot, only to the administrators
+    """
+    admins = [int(admin) for admin in os.getenv('ADMIN_USER_IDS', '').split(',') if admin.strip() != '']
+    if update.effective_user.id not in admins:
+        unknown(update, _)
+        return
+    logger.info("Sending stats to user: %s", update.effective_user.username)
+    text = 'Stats:\n'
+    text += f'Database pool: {db.get_pool_stats()}\n'
+    text += f'Menu cache: {menu_cache.stats()}\n'
+    text += f'User cache: {user_cache.stats()}\n'
+    text += f'Handler pool: {handler_pool.stats()}\n'
+    text += f'Dish index: {dish_index.stats()}'
+    # one line per histogram, packed into as many messages as needed to stay within the Telegram limit
+    reply_messages(update, [text] + [f'<code>{html.escape(line)}</code>' for line in metrics.summary()], packed=True)
+    logger.info("Sent stats to user: %s", update.effective_user.username)
+
+
+def run_in_pool(name: str, callback, ordered: bool = False):
+    """
+    Wrap a callback so that it is run in the handler pool, recording how long each call takes
+
+    @param name: The name of the command, used to label the metrics
+    @param ordered: If True the updates of the same user are handled one at a time, in the order they were received
+    """
+    timed_callback = metrics.timed_function('handler_seconds', command=name)(callback)
+
+    def submit(update: Update, context: ContextTypes):
+        key = update.effective_user.id if ordered and update.effective_user is not None else None
+        handler_pool.submit(name, timed_callback, update, context, key=key)
+    return submit
+
+
+def add_command_handler(dispatcher: Dispatcher, command: str, callback, ordered: bool = False):
+    """
+    Register a command handler run in the handler pool
+
+    @param ordered: Set for commands changing the state of the user, so that they are applied in order
+    """
+    dispatcher.add_handler(CommandHandler(command, run_in_pool(command, callback, ordered)))
+
+
+first_update_received = False
+
+
+def record_first_update(_: Update, __: ContextTypes):
+    """
+    Record the time elapsed from the start of the process to the first update received
+    """
+    global first_update_received
+    if not first_update_received:
+        first_update_received = True
+        metrics.set_gauge('time_to_first_update_seconds', time.monotonic() - START_TIME)
+        logger.info("First update received %.2f seconds after start", time.monotonic() - START_TIME)
+
+
+def set_handlers(dispatcher: Dispatcher):
     """
     Set handlers for the bot
     """
     logger.info("Setting handlers")
-    dispatcher.add_handler(CommandHandler("start", save_user))
-    dispatcher.add_handler(CommandHandler("subscribe", subscribe))
-    dispatcher.add_handler(CommandHandler("unsubscribe", unsubscribe))
-    dispatcher.add_handler(CommandHandler("stop", delete_user))
-    dispatcher.add_handler(CommandHandler("menu", today_menu))
-    dispatcher.add_handler(CommandHandler("favourite_canteen_list", get_user_canteen_list))
-    dispatcher.add_handler(CommandHandler("save_canteen_to_favourite", add_canteen_to_user_list))
-    dispatcher.add_handler(CommandHandler("remove_canteen_from_favourite", remove_canteen_from_user_list))
-    dispatcher.add_handler(CommandHandler("canteen_time", canteen_time))
-    dispatcher.add_handler(CommandHandler("favourite_canteen_menu", my_canteens_menu))
-    dispatcher.add_handler(CommandHandler("favourite_canteen_time", my_canteens_time))
-    dispatcher.add_handler(CommandHandler("available_canteen_list", available_canteen_list))
-    dispatcher.add_handler(CommandHandler("credits", bot_credits))
-    dispatcher.add_handler(CommandHandler("help", bot_help))
-    dispatcher.add_handler(CommandHandler("restart", restart))
-    dispatcher.add_handler(MessageHandler(Filters.command | Filters.text, unknown))
+    dispatcher.add_handler(TypeHandler(Update, record_first_update), group=-1)
+    add_command_handler(dispatcher, "start", save_user, ordered=True)
+    add_command_handler(dispatcher, "subscribe", subscribe, ordered=True)
+    add_command_handler(dispatcher, "unsubscribe", unsubscribe, ordered=True)
+    add_command_handler(dispatcher, "stop", delete_user, ordered=True)
+    add_command_handler(dispatcher, "menu", today_menu)
+    add_command_handler(dispatcher, "favourite_canteen_list", get_user_canteen_list)
+    add_command_handler(dispatcher, "save_canteen_to_favourite", add_canteen_to_user_list, ordered=True)
+    add_command_handler(dispatcher, "remove_canteen_from_favourite", remove_canteen_from_user_list, ordered=True)
+    add_command_handler(dispatcher, "canteen_time", canteen_time)
+    add_command_handler(dispatcher, "favourite_canteen_menu", my_canteens_menu)
+    add_command_handler(dispatcher, "favourite_canteen_time", my_canteens_time)
+    add_command_handler(dispatcher, "available_canteen_list", available_canteen_list)
+    add_command_handler(dispatcher, "search", search_dish)
+    add_command_handler(dispatcher, "credits", bot_credits)
+    add_command_handler(dispatcher, "help", bot_help)
+    add_command_handler(dispatcher, "restart", restart)
+    add_command_handler(dispatcher, "stats", bot_stats)
+    dispatcher.add_handler(InlineQueryHandler(run_in_pool('inline', inline_menu)))
+    dispatcher.add_handler(MessageHandler(Filters.command | Filters.text, run_in_pool('unknown', unknown)))
     logger.info("Set handlers")
 
 
@@ -440,14 +965,40 @@ def main():
     """
     Main function
     """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     logger.info('Starting bot...')
-    set_handlers()
+    updater = create_updater()
+    db.ensure_schema()
+    set_handlers(updater.dispatcher)
+    threading.Thread(target=load_dish_index, name='dish-index', daemon=True).start()
+    if os.getenv('METRICS_PORT'):
+        metrics.start_metrics_server(os.getenv('METRICS_LISTEN', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
     j = updater.job_queue
-    # server is 1 hh behind, so updates are sent at 9:00 am
-    j.run_daily(send_daily_updates, time=datetime.time(hour=8, minute=0, second=0))
-    updater.start_polling()
-    logger.info('Bot started')
-    updater.idle()
+    schedule_menu_refresh(j)
+    assign_default_delivery_bucket()
+    # every minute the users whose delivery slot is due are served, starting at the next minute
+    j.run_repeating(delivery_tick, interval=60, first=60 - datetime.datetime.now().second)
+    if os.getenv('PUSH_MENU_CHANGES', 'true').lower() == 'true':
+        # menus are saved on the handler and job threads, the changes are sent by the job queue
+        changes.add_listener(lambda menu_changes: j.run_once(push_menu_changes, 0, context=menu_changes))
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        metrics.set_gauge('startup_seconds', time.monotonic() - START_TIME)
+        logger.info('Bot started in webhook mode in %.2f seconds', time.monotonic() - START_TIME)
+        run_webhook(updater,
+                    listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+                    port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                    url_path=os.getenv('WEBHOOK_PATH', '/telegram'),
+                    secret_token=os.getenv('WEBHOOK_SECRET'),
+                    webhook_url=os.getenv('WEBHOOK_URL'),
+                    max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')))
+    else:
+        updater.start_polling()
+        metrics.set_gauge('startup_seconds', time.monotonic() - START_TIME)
+        logger.info('Bot started in %.2f seconds', time.monotonic() - START_TIME)
+        updater.idle()
+    logger.info('Bot stopped, database pool stats: %s, menu cache stats: %s', db.get_pool_stats(), menu_cache.stats())
+    handler_pool.shutdown()
+    db.close_connection()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+"""
+This module contains the engine used to send the same kind of message to many users,
+respecting the Telegram rate limits.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, List
+
+from pymongo import UpdateOne
+from telegram import Bot, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+
+logger = logging.getLogger(__name__)
+
+Delivery = collections.namedtuple('Delivery', ['user_id', 'chat_id', 'messages'])
+
+DELIVERED = 'delivered'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+# Telegram answers 401 for a wrong or revoked token and 403 with one of these descriptions
+# for a user who can no longer be reached, both raise Unauthorized
+BLOCKED_DESCRIPTIONS = ('bot was blocked by the user', 'user is deactivated')
+
+
+def is_blocked(exception: Unauthorized) -> bool:
+    """
+    Whether the error means that the user blocked the bot or deleted their account
+    """
+    return any(description in exception.message.lower() for description in BLOCKED_DESCRIPTIONS)
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of the requests, shared by all the threads using it
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens for the specified number of seconds
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class Broadcaster:
+    """
+    Sends messages to many chats through a bounded pool of senders
+
+    The global rate and the rate of each chat are limited by token buckets, RetryAfter pauses all the
+    senders for the time requested by Telegram, network errors are retried with exponential backoff.
+    """
+    def __init__(self, bot: Bot, rate: float = None, workers: int = None, retries: int = None,
+                 backoff: float = None, chat_rate: float = None, chat_burst: float = None):
+        self.bot = bot
+        self.rate = rate if rate is not None else float(os.getenv('BROADCAST_RATE', '25'))
+        self.workers = workers if workers is not None else int(os.getenv('BROADCAST_WORKERS', '8'))
+        self.retries = retries if retries is not None else int(os.getenv('BROADCAST_RETRIES', '5'))
+        self.backoff = backoff if backoff is not None else float(os.getenv('BROADCAST_BACKOFF', '1'))
+        self.chat_rate = chat_rate if chat_rate is not None else float(os.getenv('BROADCAST_CHAT_RATE', '1'))
+        self.chat_burst = chat_burst if chat_burst is not None else float(os.getenv('BROADCAST_CHAT_BURST', '3'))
+        self._bucket = TokenBucket(self.rate, self.rate)
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._unauthorized = threading.Event()
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _send_message(self, chat_id: int, text: str, chat_bucket: TokenBucket) -> str:
+        for attempt in range(self.retries):
+            self._bucket.acquire()
+            chat_bucket.acquire()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+                self._count('messages')
+                return DELIVERED
+            except RetryAfter as exception:
+                logger.warning("Rate limited by Telegram, pausing for %s seconds", exception.retry_after)
+                self._count('retries')
+                self._bucket.pause(exception.retry_after)
+            except Unauthorized as exception:
+                if is_blocked(exception):
+                    return BLOCKED
+                # the bot itself is not authorized, no other chat can be reached either
+                self._unauthorized.set()
+                raise
+            except BadRequest as exception:
+                logger.warning("Cannot send message to chat %s: %s", chat_id, exception)
+                return FAILED
+            except NetworkError as exception:
+                logger.warning("Network error sending message to chat %s: %s", chat_id, exception)
+                self._count('retries')
+                time.sleep(self.backoff * 2 ** attempt)
+        return FAILED
+
+    def _deliver(self, delivery: Delivery) -> str:
+        if self._unauthorized.is_set():
+            return FAILED
+        chat_bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        for text in delivery.messages:
+            outcome = self._send_message(delivery.chat_id, text, chat_bucket)
+            if outcome != DELIVERED:
+                return outcome
+        return DELIVERED
+
+    def run(self, deliveries: Iterable[Delivery], on_delivered: Callable[[Delivery], None] = None,
+            on_blocked: Callable[[Delivery], None] = None) -> dict:
+        """
+        Send all the deliveries
+
+        @param deliveries: The messages to send, grouped by chat
+        @param on_delivered: Called once all the messages of a delivery have been sent
+        @param on_blocked: Called when the user of a delivery blocked the bot
+
+        @return: The statistics of the run
+
+        @raise Unauthorized: If the bot token is not valid, the run is stopped without marking any user
+        """
+        self._stats = collections.Counter()
+        self._unauthorized.clear()
+        start = time.monotonic()
+        unauthorized = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='broadcast') as executor:
+            futures = {executor.submit(self._deliver, delivery): delivery for delivery in deliveries}
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                delivery = futures[future]
+                try:
+                    outcome = future.result()
+                except Unauthorized as exception:
+                    if unauthorized is None:
+                        logger.error("The bot is not authorized, stopping the broadcast: %s", exception)
+                        unauthorized = exception
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                except Exception as exception:
+                    logger.error("Cannot deliver to chat %s: %s", delivery.chat_id, exception)
+                    outcome = FAILED
+                self._count(outcome)
+                if outcome == DELIVERED and on_delivered is not None:
+                    on_delivered(delivery)
+                elif outcome == BLOCKED and on_blocked is not None:
+                    on_blocked(delivery)
+        if unauthorized is not None:
+            raise unauthorized
+        elapsed = time.monotonic() - start
+        stats = dict(self._stats)
+        stats['seconds'] = elapsed
+        stats['messages_per_second'] = stats.get('messages', 0) / elapsed if elapsed > 0 else 0.0
+        return stats
+
+
+class DeliveryCheckpoint:
+    """
+    Records which users already received a broadcast, so that an interrupted run can be resumed
+
+    The updates are written in batches, at most batch_size users are sent the same message twice
+    after a crash. Without a field only the users who blocked the bot are recorded.
+    """
+    def __init__(self, collection, field: str = None, value=None, batch_size: int = None):
+        self.collection = collection
+        self.field = field
+        self.value = value
+        self.batch_size = batch_size if batch_size is not None else int(os.getenv('BROADCAST_CHECKPOINT_BATCH', '50'))
+        self._pending: List[UpdateOne] = []
+        self._lock = threading.Lock()
+
+    def delivered(self, delivery: Delivery):
+        """
+        Mark the user of the delivery as served
+        """
+        self._add(UpdateOne({'id': delivery.user_id}, {'$set': {self.field: self.value}}))
+
+    def blocked(self, delivery: Delivery):
+        """
+        Mark the user of the delivery as inactive, since they blocked the bot
+        """
+        self._add(UpdateOne({'id': delivery.user_id}, {'$set': {'send_daily_updates': False, 'active': False}}))
+
+    def _add(self, operation: UpdateOne):
+        with self._lock:
+            self._pending.append(operation)
+            if len(self._pending) < self.batch_size:
+                return
+            pending, self._pending = self._pending, []
+        self.collection.bulk_write(pending, ordered=False)
+
+    def flush(self):
+        """
+        Write the pending updates
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if len(pending) > 0:
+            self.collection.bulk_write(pending, ordered=False)
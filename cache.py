@@ -0,0 +1,177 @@
+"""
+This module contains the in-process caches used to avoid hitting the database on every command.
+"""
+import collections
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics
+
+
+class MenuCache:
+    """
+    Cache of the menu documents, keyed by date and canteen
+
+    A date is served from the cache only once all its canteens have been loaded with put_day,
+    entries expire after ttl seconds and are dropped by invalidate whenever the menus are saved.
+    The generation is incremented by every put_day and invalidate, so values derived from the menus
+    can tell when they must be rebuilt.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str], dict] = {}
+        self._days: Dict[str, float] = {}
+
+    def get_day(self, date: str) -> Optional[List[dict]]:
+        """
+        Get all the menu documents of the specified day, None if the day is not cached
+        """
+        with self._lock:
+            expires = self._days.get(date)
+            if expires is None or expires < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [document for (day, _), document in self._entries.items() if day == date]
+
+    def put_day(self, date: str, documents: List[dict]):
+        """
+        Store all the menu documents of the specified day
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == date]:
+                del self._entries[key]
+            for document in documents:
+                self._entries[(date, document['canteen'])] = document
+            self._days[date] = time.monotonic() + self.ttl
+            self.generation += 1
+
+    def invalidate(self, date: str = None, canteens: List[str] = None):
+        """
+        Drop the cached documents of the specified date and canteens, everything if nothing is specified
+        """
+        with self._lock:
+            self.generation += 1
+            if date is None:
+                self._entries.clear()
+                self._days.clear()
+                return
+            self._days.pop(date, None)
+            for key in list(self._entries):
+                if key[0] == date and (canteens is None or key[1] in canteens):
+                    del self._entries[key]
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters of the cache
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)
+            }
+
+
+class DayTable:
+    """
+    Value derived from the menus of a day, built once and rebuilt only when the day or the menus change
+
+    Like the cache entries, the value expires after the ttl of the cache, so menus saved by other
+    processes are eventually seen even if nothing reloads them into this cache.
+    """
+    def __init__(self, cache: MenuCache):
+        self.cache = cache
+        self.builds = 0
+        self._lock = threading.Lock()
+        self._key: Tuple[str, int] = None
+        self._expires = 0.0
+        self._value = None
+
+    def get(self, date: str, build: Callable[[], object]):
+        """
+        Get the value of the specified day, calling build if it is missing or outdated
+        """
+        key = (date, self.cache.generation)
+        with self._lock:
+            if self._key == key and self._expires >= time.monotonic():
+                return self._value
+        value = build()
+        with self._lock:
+            self._key = key
+            self._expires = time.monotonic() + self.cache.ttl
+            self._value = value
+            self.builds += 1
+        return value
+
+
+class UserCache:
+    """
+    Bounded cache of the user profiles, keyed by user id
+
+    Writes go to the database first and the updated document is then stored with put, so the cache
+    is never older than the database for updates made by this process. The least recently used
+    profiles are dropped once max_size is reached, entries expire after ttl seconds so updates made
+    by other processes are eventually seen.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        """
+        Get the profile of the specified user, None if it is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: int, profile: dict):
+        """
+        Store the profile of the specified user, dropping the least recently used one if the cache is full
+        """
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """
+        Drop the profile of the specified user
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters of the cache
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries)
+            }
+
+
+menu_cache = MenuCache(ttl=float(os.getenv('MENU_CACHE_TTL', '3600')))
+metrics.register_collector('menu_cache', menu_cache.stats)
+
+user_cache = UserCache(max_size=int(os.getenv('USER_CACHE_SIZE', '10000')), ttl=float(os.getenv('USER_CACHE_TTL', '300')))
+metrics.register_collector('user_cache', user_cache.stats)
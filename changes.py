@@ -0,0 +1,95 @@
+"""
+This module detects the changes of a menu saved again during the day.
+
+The parsed menu and timetable of a canteen are hashed, so a refresh returning the same content
+is not written again. When the content does change, the differences are computed turn by turn
+and passed to the registered listeners, which notify the interested users.
+"""
+import hashlib
+import json
+import logging
+import threading
+from typing import Callable, Dict, List, NamedTuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class MenuChange(NamedTuple):
+    """
+    The differences between two menus of the same canteen and day
+    """
+    date: str
+    canteen: str
+    diff: Dict[str, dict]
+
+
+def content_hash(menu: Dict[str, Dict[str, List[str]]], time: Dict[str, Dict[str, object]]) -> str:
+    """
+    Get the hash of a parsed menu and timetable, independent of the order of the keys
+    """
+    return hashlib.sha256(json.dumps([menu, time], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def diff_menu(old_menu: Dict[str, Dict[str, List[str]]], old_time: Dict[str, Dict[str, object]],
+              new_menu: Dict[str, Dict[str, List[str]]], new_time: Dict[str, Dict[str, object]]) -> Dict[str, dict]:
+    """
+    Get the differences between two menus of a canteen
+
+    @return: For each changed turn, a dictionary with 'closed' or 'reopened' if the turn changed state,
+        'hours' if the opening hours changed, and the dishes 'added' and 'removed' for each course
+    """
+    diff = {}
+    for turn in new_time:
+        old_open = old_time.get(turn, {}).get('IsOpen', False)
+        new_open = new_time[turn].get('IsOpen', False)
+        changes = {}
+        if old_open and not new_open:
+            changes['closed'] = True
+        if new_open:
+            if not old_open:
+                changes['reopened'] = True
+            hours = (new_time[turn].get('OpenTime'), new_time[turn].get('CloseTime'))
+            if old_open and hours != (old_time[turn].get('OpenTime'), old_time[turn].get('CloseTime')):
+                changes['hours'] = f'{hours[0]} - {hours[1]}'
+            old_courses = old_menu.get(turn, {}) if old_open else {}
+            new_courses = new_menu.get(turn, {})
+            # courses removed altogether only appear in the old menu
+            for course in dict.fromkeys(list(new_courses) + list(old_courses)):
+                dishes = new_courses.get(course, [])
+                added = [dish for dish in dishes if dish not in old_courses.get(course, [])]
+                removed = [dish for dish in old_courses.get(course, []) if dish not in dishes]
+                if len(added) > 0:
+                    changes.setdefault('added', {})[course] = added
+                if len(removed) > 0 and old_open:
+                    changes.setdefault('removed', {})[course] = removed
+        if len(changes) > 0:
+            diff[turn] = changes
+    return diff
+
+
+_listeners: List[Callable[[List[MenuChange]], None]] = []
+_listeners_lock = threading.Lock()
+
+
+def add_listener(listener: Callable[[List[MenuChange]], None]):
+    """
+    Register a function called with the changes of every save changing menus already saved today
+    """
+    with _listeners_lock:
+        _listeners.append(listener)
+
+
+def notify(menu_changes: List[MenuChange]):
+    """
+    Pass the changes to every listener, a failing listener does not stop the others
+    """
+    if len(menu_changes) <= 0:
+        return
+    with _listeners_lock:
+        listeners = list(_listeners)
+    for listener in listeners:
+        try:
+            listener(menu_changes)
+        except Exception:
+            logger.exception("Error while notifying menu changes")
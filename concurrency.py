@@ -0,0 +1,102 @@
+"""
+This module contains the pool running the command handlers outside the dispatcher thread.
+
+A slow command, for example a /menu waiting for a refresh, only holds one worker, so the other
+users are still served. Commands changing the state of a user are given the user id as ordering key
+and are run one at a time per user, in the order they were received.
+"""
+import collections
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Deque, Dict, Hashable
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerPool:
+    """
+    Bounded pool of workers running the handlers, with optional per-key ordering
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self._lock = threading.Lock()
+        self._ordered: Dict[Hashable, Deque[Callable[[], None]]] = {}
+        self._queued = 0
+        self._running = 0
+
+    def submit(self, name: str, function: Callable, *args, key: Hashable = None):
+        """
+        Run the function in the pool
+
+        @param name: The name used to label the wait time metrics
+        @param key: If set, the functions submitted with the same key are run one at a time in submission order
+        """
+        task = functools.partial(self._run, name, time.monotonic(), function, args)
+        with self._lock:
+            self._queued += 1
+            metrics.set_gauge('handler_queue_depth', self._queued)
+            if key is not None:
+                pending = self._ordered.get(key)
+                if pending is not None:
+                    pending.append(task)
+                    return
+                self._ordered[key] = collections.deque()
+        if key is None:
+            self._executor.submit(task)
+        else:
+            self._executor.submit(self._run_ordered, key, task)
+
+    def _run(self, name: str, submitted: float, function: Callable, args: tuple):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            metrics.set_gauge('handler_queue_depth', self._queued)
+        metrics.observe('handler_wait_seconds', time.monotonic() - submitted, command=name)
+        try:
+            function(*args)
+        except Exception:
+            logger.exception("Error while handling %s", name)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _run_ordered(self, key: Hashable, task: Callable[[], None]):
+        while task is not None:
+            task()
+            with self._lock:
+                pending = self._ordered[key]
+                if len(pending) > 0:
+                    task = pending.popleft()
+                else:
+                    del self._ordered[key]
+                    task = None
+
+    def stats(self) -> dict:
+        """
+        Get the number of queued and running handlers
+        """
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queued': self._queued,
+                'running': self._running,
+                'ordered_keys': len(self._ordered)
+            }
+
+    def shutdown(self):
+        """
+        Wait for the submitted handlers to complete, then stop the workers
+        """
+        self._executor.shutdown(wait=True)
+
+
+handler_pool = HandlerPool(workers=int(os.getenv('HANDLER_WORKERS', '8')))
+metrics.register_collector('handler_pool', handler_pool.stats)
@@ -1,29 +1,236 @@
 """
 This module contains the connection to the database.
+
+A single pooled MongoClient is shared by the whole process, it is created on first use
+and closed by close_connection when the bot shuts down.
 """
+import logging
 import os
+import threading
+
 import pymongo
+from pymongo import monitoring
+from pymongo.errors import OperationFailure
+from pymongo.collection import Collection
+from pymongo.database import Database
 from dotenv import load_dotenv
 
+import metrics
+
 
 load_dotenv()
 
-def open_connection() -> pymongo.MongoClient:
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Keeps track of the connections opened by the shared client, used to size the pool
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failed += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def stats(self) -> dict:
+        """
+        Returns a snapshot of the pool counters
+        """
+        with self._lock:
+            return {
+                'open': self.created - self.closed,
+                'in_use': self.checked_out,
+                'created': self.created,
+                'closed': self.closed,
+                'checkout_failed': self.checkout_failed
+            }
+
+
+class CommandTimingListener(monitoring.CommandListener):
+    """
+    Records the duration of every command sent to the database
+    """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe('mongo_command_seconds', event.duration_micros / 1000000, command=event.command_name)
+
+    def failed(self, event):
+        metrics.observe('mongo_command_seconds', event.duration_micros / 1000000, command=event.command_name)
+        metrics.increment('mongo_command_seconds_errors_total', command=event.command_name)
+
+
+_client = None
+_client_lock = threading.Lock()
+_pool_stats = PoolStatsListener()
+metrics.register_collector('mongo_pool', _pool_stats.stats)
+
+
+def get_client() -> pymongo.MongoClient:
+    """
+    Get the shared connection to the database, it is created on first use
+
+    The pool is configured by the DB_MAX_POOL_SIZE, DB_MIN_POOL_SIZE, DB_CONNECT_TIMEOUT_MS,
+    DB_SOCKET_TIMEOUT_MS and DB_SERVER_SELECTION_TIMEOUT_MS environment variables
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = pymongo.MongoClient(
+                    os.getenv('DB_CONNECTION_STRING'),
+                    maxPoolSize=int(os.getenv('DB_MAX_POOL_SIZE', '20')),
+                    minPoolSize=int(os.getenv('DB_MIN_POOL_SIZE', '0')),
+                    connectTimeoutMS=int(os.getenv('DB_CONNECT_TIMEOUT_MS', '10000')),
+                    socketTimeoutMS=int(os.getenv('DB_SOCKET_TIMEOUT_MS', '30000')),
+                    serverSelectionTimeoutMS=int(os.getenv('DB_SERVER_SELECTION_TIMEOUT_MS', '10000')),
+                    event_listeners=[_pool_stats, CommandTimingListener()]
+                )
+    return _client
+
+
+def set_client(client):
     """
-    Open connection to the database
+    Replace the shared connection, closing the previous one
+
+    Used by the load test to run the bot against a local server or an in-memory stand-in
+    exposing the MongoClient interface.
     """
-    return pymongo.MongoClient(os.getenv('DB_CONNECTION_STRING'))
+    global _client
+    with _client_lock:
+        if _client is not None and _client is not client:
+            _client.close()
+        _client = client
 
 
-def get_data_base(mongo_client = open_connection(), data_base_name = os.getenv('DB_NAME')):
+def get_data_base(data_base_name: str = None) -> Database:
     """
     Get database
     """
-    return mongo_client[data_base_name]
+    if data_base_name is None:
+        data_base_name = os.getenv('DB_NAME')
+    return get_client()[data_base_name]
+
+
+def get_collection(collection_name: str) -> Collection:
+    """
+    Get a collection of the database, borrowing a connection from the shared pool
+    """
+    return get_data_base()[collection_name]
+
+
+def get_user_collection() -> Collection:
+    """
+    Get the collection containing the users
+    """
+    return get_collection(os.getenv('DB_USER_COLLECTION'))
+
+
+def get_menu_collection() -> Collection:
+    """
+    Get the collection containing the daily menus
+    """
+    return get_collection(os.getenv('DB_MENU_COLLECTION'))
+
+
+def get_archive_collection() -> Collection:
+    """
+    Get the collection containing the menus of every day, keyed by date and canteen
+    """
+    return get_collection(os.getenv('DB_ARCHIVE_COLLECTION', 'menu_archive'))
+
+
+def get_dish_collection() -> Collection:
+    """
+    Get the collection containing the names of the dishes, keyed by their integer id
+    """
+    return get_collection(os.getenv('DB_DISH_COLLECTION', 'dishes'))
+
+
+def get_counter_collection() -> Collection:
+    """
+    Get the collection containing the counters used to assign the integer ids
+    """
+    return get_collection(os.getenv('DB_COUNTER_COLLECTION', 'counters'))
+
+
+def ensure_schema():
+    """
+    Create the indexes used by the queries of the bot, existing indexes are left untouched
+    """
+    indexes = [
+        (get_user_collection(), [('id', pymongo.ASCENDING)], {'unique': True}),
+        (get_user_collection(), [('send_daily_updates', pymongo.ASCENDING), ('last_daily_update', pymongo.ASCENDING)],
+         {'partialFilterExpression': {'send_daily_updates': True}}),
+        (get_user_collection(), [('delivery_bucket', pymongo.ASCENDING), ('last_daily_update', pymongo.ASCENDING)],
+         {'partialFilterExpression': {'send_daily_updates': True}}),
+        (get_menu_collection(), [('date', pymongo.ASCENDING), ('canteen', pymongo.ASCENDING)], {}),
+        (get_menu_collection(), [('canteen', pymongo.ASCENDING)], {'unique': True}),
+        (get_archive_collection(), [('date', pymongo.ASCENDING), ('canteen', pymongo.ASCENDING)], {'unique': True}),
+        (get_dish_collection(), [('name', pymongo.ASCENDING)], {'unique': True}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except OperationFailure as exception:
+            logger.error("Cannot create index %s on %s: %s", keys, collection.name, exception)
+
+
+def get_pool_stats() -> dict:
+    """
+    Get the connection pool counters of the shared client
+    """
+    return _pool_stats.stats()
 
 
-def close_connection(mongo_client = open_connection()):
+def close_connection():
     """
-    Close connection to the database
+    Close connection to the database, to be called once on shutdown
     """
-    mongo_client.close()
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
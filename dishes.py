@@ -0,0 +1,151 @@
+"""
+This module contains the compact storage format of the menu documents.
+
+Dish names are interned in the dishes collection, each one with a stable integer id, and the menus
+store arrays of ids for each turn and course instead of the names. The timetable is stored with a
+fixed shape, one [is_open, open_time, close_time] array per turn. Documents in this format have
+their format field set to STORAGE_FORMAT, decode_documents rebuilds the nested dictionaries used
+by the bot and returns the documents still in the previous format unchanged.
+"""
+import threading
+from typing import Dict, Iterable, List
+
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+import data_base as db
+import metrics
+
+
+STORAGE_FORMAT = 2
+
+TURNS = ('Pranzo', 'Cena')
+
+
+class DishDictionary:
+    """
+    In-memory copy of the dishes collection, mapping names to ids and back
+
+    New names are given ids reserved in blocks from a counter, so ids stay stable and unique even
+    when many processes save menus at the same time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._intern_lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+        self._names: Dict[int, str] = {}
+
+    def _load(self, query: dict):
+        for document in db.get_dish_collection().find(query):
+            with self._lock:
+                self._ids[document['name']] = document['_id']
+                self._names[document['_id']] = document['name']
+
+    def load(self):
+        """
+        Load the whole dictionary, so that decoding never needs the database
+        """
+        self._load({})
+
+    def encode(self, names: Iterable[str]) -> Dict[str, int]:
+        """
+        Get the ids of the specified dishes, interning the new ones
+
+        @return: The ids keyed by dish name
+        """
+        names = set(names)
+        with self._lock:
+            missing = [name for name in names if name not in self._ids]
+        if len(missing) > 0:
+            self._intern(missing)
+        with self._lock:
+            return {name: self._ids[name] for name in names}
+
+    def _intern(self, names: List[str]):
+        with self._intern_lock:
+            self._load({'name': {'$in': names}})
+            with self._lock:
+                missing = [name for name in names if name not in self._ids]
+            if len(missing) <= 0:
+                return
+            counter = db.get_counter_collection().find_one_and_update(
+                {'_id': 'dishes'}, {'$inc': {'seq': len(missing)}}, upsert=True, return_document=ReturnDocument.AFTER)
+            first_id = counter['seq'] - len(missing) + 1
+            try:
+                db.get_dish_collection().insert_many(
+                    [{'_id': first_id + index, 'name': name} for index, name in enumerate(missing)], ordered=False)
+            except BulkWriteError:
+                # another process interned some of the names first, its ids are loaded below
+                pass
+            self._load({'name': {'$in': missing}})
+
+    def decode(self, ids: Iterable[int]) -> Dict[int, str]:
+        """
+        Get the names of the specified dish ids, loading the ones saved by other processes
+
+        @return: The names keyed by dish id
+        """
+        ids = set(ids)
+        with self._lock:
+            missing = [dish_id for dish_id in ids if dish_id not in self._names]
+        if len(missing) > 0:
+            self._load({'_id': {'$in': missing}})
+        with self._lock:
+            return {dish_id: self._names.get(dish_id, '') for dish_id in ids}
+
+    def stats(self) -> dict:
+        """
+        Get the number of dishes known by the process
+        """
+        with self._lock:
+            return {'entries': len(self._ids)}
+
+
+dish_dictionary = DishDictionary()
+metrics.register_collector('dish_dictionary', dish_dictionary.stats)
+
+
+def encode_document(menu: Dict[str, Dict[str, List[str]]], time: Dict[str, Dict[str, object]]) -> dict:
+    """
+    Get the compact fields of a menu document
+
+    @return: The menu, time and format fields to save
+    """
+    ids = dish_dictionary.encode(dish for courses in menu.values() for dishes in courses.values() for dish in dishes)
+    return {
+        'menu': {turn: {course: [ids[dish] for dish in dishes] for course, dishes in courses.items()}
+                 for turn, courses in menu.items()},
+        'time': [[time[turn]['IsOpen'], time[turn]['OpenTime'], time[turn]['CloseTime']] if turn in time
+                 else [False, '-', '-'] for turn in TURNS],
+        'format': STORAGE_FORMAT
+    }
+
+
+def decode_documents(documents: Iterable[dict]) -> List[dict]:
+    """
+    Rebuild the menu and time dictionaries of the documents saved in the compact format
+
+    The names of all the documents are looked up at once, documents in the previous format
+    are returned unchanged.
+    """
+    documents = list(documents)
+    compact = [document for document in documents if document.get('format') == STORAGE_FORMAT]
+    if len(compact) <= 0:
+        return documents
+    names = dish_dictionary.decode(dish_id for document in compact for courses in document.get('menu', {}).values()
+                                   for dishes in courses.values() for dish_id in dishes)
+    decoded = []
+    for document in documents:
+        if document.get('format') != STORAGE_FORMAT:
+            decoded.append(document)
+            continue
+        document = dict(document)
+        del document['format']
+        if 'menu' in document:
+            document['menu'] = {turn: {course: [names[dish_id] for dish_id in dishes] for course, dishes in courses.items()}
+                                for turn, courses in document['menu'].items()}
+        if 'time' in document:
+            document['time'] = {turn: {'IsOpen': is_open, 'OpenTime': open_time, 'CloseTime': close_time}
+                                for turn, (is_open, open_time, close_time) in zip(TURNS, document['time'])}
+        decoded.append(document)
+    return decoded
@@ -0,0 +1,359 @@
+"""
+Offline load test of the bot.
+
+The bot runs in process against local stand-ins of every external service: a fake Bot API server
+simulating latency, 429 RetryAfter replies and chats that blocked the bot, an in-memory Mongo
+(mongomock, pip install mongomock) or a local mongod, and an http server serving the saved ERDIS
+pages of the fixtures folder. Synthetic users are seeded, their commands are dispatched through the
+same handlers used in production, then the daily broadcast is run. Throughput, latency percentiles
+and memory are reported and compared against a stored baseline.
+
+Usage:
+    python loadtest.py [--users N] [--commands N] [--mongo memory|mongodb://127.0.0.1:27017] [--update-baseline]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+import bot as bot_module
+import data_base as db
+import menu as menu_module
+import metrics
+from concurrency import handler_pool
+from page_cache import page_cache
+
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+BASELINE_FILE = os.path.join(FIXTURES_FOLDER, 'loadtest_baseline.json')
+
+COMMANDS = [
+    ('/menu', 4),
+    ('/menu {canteen}', 3),
+    ('/canteen_time {canteen}', 2),
+    ('/favourite_canteen_list', 2),
+    ('/favourite_canteen_menu', 3),
+    ('/favourite_canteen_time', 1),
+    ('/save_canteen_to_favourite {canteen}', 1),
+    ('/remove_canteen_from_favourite {canteen}', 1),
+    ('/search pasta', 1),
+    ('/help', 1),
+]
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """
+    Answers the Bot API methods used by the bot
+    """
+    def _reply(self, status_code: int, content: dict):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """
+        Reply to a Bot API call after the simulated latency
+        """
+        server = self.server
+        method = self.path.rsplit('/', 1)[-1]
+        length = int(self.headers.get('Content-Length', '0'))
+        data = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(random.uniform(0, 2 * server.latency))
+        if method == 'getMe':
+            server.count(method, 200)
+            self._reply(200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Load test',
+                                                     'username': 'loadtestbot'}})
+            return
+        if method != 'sendMessage':
+            server.count(method, 200)
+            self._reply(200, {'ok': True, 'result': True})
+            return
+        chat_id = int(data.get('chat_id', 0))
+        if chat_id in server.blocked_chats:
+            server.count(method, 403)
+            self._reply(403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'})
+            return
+        if random.random() < server.rate_limit_ratio:
+            server.count(method, 429)
+            self._reply(429, {'ok': False, 'error_code': 429,
+                              'description': f'Too Many Requests: retry after {server.retry_after}',
+                              'parameters': {'retry_after': server.retry_after}})
+            return
+        server.count(method, 200)
+        self._reply(200, {'ok': True, 'result': {'message_id': 1, 'date': int(time.time()), 'text': data.get('text', ''),
+                                                 'chat': {'id': chat_id, 'type': 'private'}}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """
+    Fake Bot API server, counting the calls received by method and status code
+    """
+    daemon_threads = True
+
+    def __init__(self, latency: float, rate_limit_ratio: float, retry_after: int):
+        super().__init__(('127.0.0.1', 0), FakeBotApiHandler)
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.blocked_chats = set()
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def count(self, method: str, status_code: int):
+        """
+        Count a call
+        """
+        with self._lock:
+            key = f'{method}:{status_code}'
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    Serves a saved ERDIS page for every menu url, each canteen always gets the same page
+    """
+    def do_GET(self):
+        """
+        Reply with the fixture page of the canteen in the url
+        """
+        pages = self.server.pages
+        body = pages[zlib.crc32(self.path.split('/')[1].encode('utf-8')) % len(pages)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """
+    Local stand-in of the ERDIS site
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FixtureHandler)
+        self.pages = []
+        for file_name in sorted(glob.glob(os.path.join(FIXTURES_FOLDER, '*.html'))):
+            with open(file_name, 'rb') as html_file:
+                self.pages.append(html_file.read())
+
+
+def start(server: ThreadingHTTPServer) -> str:
+    """
+    Serve in a background thread
+
+    @return: The base url of the server
+    """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def connect_mongo(mongo: str):
+    """
+    Point the bot to the in-memory stand-in or to a local mongod, using a dedicated database
+    """
+    os.environ['DB_NAME'] = 'erdis_loadtest'
+    os.environ['DB_USER_COLLECTION'] = 'users'
+    os.environ['DB_MENU_COLLECTION'] = 'menus'
+    os.environ['DB_ARCHIVE_COLLECTION'] = 'menu_archive'
+    if mongo == 'memory':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is not installed, install it or pass --mongo with the url of a local mongod')
+        db.set_client(mongomock.MongoClient())
+    else:
+        os.environ['DB_CONNECTION_STRING'] = mongo
+        db.close_connection()
+        db.get_client().drop_database('erdis_loadtest')
+
+
+def seed_users(users: int, blocked_ratio: float, api: FakeBotApi):
+    """
+    Insert the synthetic subscribers, a share of them blocked the bot
+    """
+    names = [canteen.value.lower() for canteen in menu_module.Canteen]
+    documents = []
+    for user_id in range(1, users + 1):
+        documents.append({'id': user_id, 'chat_id': user_id, 'first_name': f'User {user_id}', 'last_name': None,
+                          'username': f'user{user_id}', 'send_daily_updates': True, 'active': True,
+                          'delivery_bucket': random.randrange(7 * 60, 12 * 60, 30),
+                          'canteen_list': random.sample(names, random.randint(0, 3))})
+        if random.random() < blocked_ratio:
+            api.blocked_chats.add(user_id)
+    for index in range(0, len(documents), 1000):
+        db.get_user_collection().insert_many(documents[index:index + 1000])
+
+
+def build_update(update_id: int, user_id: int, text: str, bot) -> Update:
+    """
+    Build the update Telegram would send for a command
+    """
+    command_length = len(text.split(' ')[0])
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}', 'username': f'user{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        }
+    }, bot)
+
+
+def run_commands(dispatcher, commands: int, rate: float, users: int, blocked_chats: set) -> dict:
+    """
+    Dispatch random commands of random users, then wait for all of them to be handled
+    """
+    names = [canteen.value for canteen in menu_module.Canteen]
+    templates = [template for template, weight in COMMANDS for _ in range(weight)]
+    active_users = [user_id for user_id in range(1, users + 1) if user_id not in blocked_chats]
+    start_time = time.perf_counter()
+    for update_id in range(1, commands + 1):
+        text = random.choice(templates).format(canteen=random.choice(names))
+        dispatcher.process_update(build_update(update_id, random.choice(active_users), text, dispatcher.bot))
+        if rate > 0:
+            delay = start_time + update_id / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    while True:
+        stats = handler_pool.stats()
+        if stats['queued'] <= 0 and stats['running'] <= 0:
+            break
+        time.sleep(0.01)
+    seconds = time.perf_counter() - start_time
+    return {
+        'count': commands,
+        'seconds': seconds,
+        'per_second': commands / seconds if seconds > 0 else 0,
+        'latency': metrics.histogram_stats('handler_seconds'),
+        'wait': metrics.histogram_stats('handler_wait_seconds')
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Print the ratio of every measure to the baseline
+
+    @return: True if a measure regressed by more than the tolerance
+    """
+    regressed = False
+    checks = [('command throughput', report['commands']['per_second'], baseline.get('commands', {}).get('per_second'), True),
+              ('broadcast throughput', report['broadcast'].get('messages_per_second'),
+               baseline.get('broadcast', {}).get('messages_per_second'), True)]
+    for command, latency in report['commands']['latency'].items():
+        checks.append((f'{command} p95', latency['p95'],
+                       baseline.get('commands', {}).get('latency', {}).get(command, {}).get('p95'), False))
+    for name, value, previous, higher_is_better in checks:
+        if not previous:
+            continue
+        ratio = previous / value if higher_is_better and value else value / previous
+        line = f'\t{name:<40}{ratio:>8.2f}x'
+        if ratio > tolerance:
+            line += ' REGRESSION'
+            regressed = True
+        print(line)
+    return regressed
+
+
+def main():
+    """
+    Load test main function
+    """
+    parser = argparse.ArgumentParser(description='Load test the bot against local fake services')
+    parser.add_argument('--users', type=int, default=10000, help='synthetic subscribers')
+    parser.add_argument('--commands', type=int, default=2000, help='commands sent by random users')
+    parser.add_argument('--rate', type=float, default=0, help='commands sent per second, 0 for as fast as possible')
+    parser.add_argument('--mongo', default='memory', help='memory for mongomock, or the url of a local mongod')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of the fake Bot API, in seconds')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.001, help='share of messages answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds requested by the 429 replies')
+    parser.add_argument('--blocked-ratio', type=float, default=0.02, help='share of users who blocked the bot')
+    parser.add_argument('--broadcast-rate', type=float, help='global broadcast rate, BROADCAST_RATE if not set')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='ratio against the baseline reported as a regression')
+    parser.add_argument('--update-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    arguments = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    random.seed(arguments.seed)
+
+    api = FakeBotApi(arguments.latency, arguments.rate_limit_ratio, arguments.retry_after)
+    os.environ['TELEGRAM_BASE_URL'] = start(api) + '/bot'
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123456:loadtest'
+    os.environ['ERDIS_BASE_URL'] = start(FixtureServer())
+    if arguments.broadcast_rate is not None:
+        os.environ['BROADCAST_RATE'] = str(arguments.broadcast_rate)
+    page_cache.folder = tempfile.mkdtemp(prefix='loadtest_pages_')
+    connect_mongo(arguments.mongo)
+    db.ensure_schema()
+
+    report = {}
+    start_time = time.perf_counter()
+    menu_module.init_menu(force=True)
+    report['refresh_seconds'] = time.perf_counter() - start_time
+    print(f'Menu refresh: {report["refresh_seconds"]:.2f} s')
+
+    bot_module.load_dish_index()
+    seed_users(arguments.users, arguments.blocked_ratio, api)
+    updater = bot_module.create_updater()
+    bot_module.set_handlers(updater.dispatcher)
+    report['commands'] = run_commands(updater.dispatcher, arguments.commands, arguments.rate, arguments.users,
+                                      api.blocked_chats)
+    print(f'Commands: {arguments.commands} in {report["commands"]["seconds"]:.2f} s '
+          f'({report["commands"]["per_second"]:.1f}/s)')
+    for command, latency in report['commands']['latency'].items():
+        wait = report['commands']['wait'].get(command, {})
+        print(f'\t{command:<32}n={latency["count"]:<6}p50={latency["p50"] * 1000:>8.1f} ms'
+              f'  p95={latency["p95"] * 1000:>8.1f} ms  p99={latency["p99"] * 1000:>8.1f} ms'
+              f'  wait p95={wait.get("p95", 0) * 1000:>8.1f} ms')
+
+    report['broadcast'] = bot_module.send_daily_updates(types.SimpleNamespace(bot=updater.bot))
+    print(f'Broadcast: {report["broadcast"]}')
+    report['fake_api_calls'] = dict(sorted(api.calls.items()))
+    print(f'Fake Bot API calls: {report["fake_api_calls"]}')
+    report['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Peak memory: {report["peak_rss_mib"]:.1f} MiB')
+
+    handler_pool.shutdown()
+    db.close_connection()
+    if arguments.update_baseline:
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+            json_file.write('\n')
+        print('Baseline updated')
+        return
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding='utf-8') as json_file:
+            baseline = json.load(json_file)
+        print('Against the baseline:')
+        sys.exit(1 if compare(report, baseline, arguments.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
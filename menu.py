@@ -3,22 +3,36 @@ This is the main file of the project.
 TODO: Add description
 @Author: Harlock Official https://github.com/HarlockOfficial
 """
+import concurrent.futures
 import datetime
 import enum
+import functools
+import logging
 import os
-from typing import List, Dict
+import threading
+import time as time_module
+from typing import List, Dict, Tuple
 
 import requests
-from bs4 import BeautifulSoup
+from pymongo import ReplaceOne
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from lxml.html.clean import Cleaner
 
+import changes
 import data_base as db
+import dishes
+import metrics
+from cache import menu_cache
+from page_cache import fetch, page_cache
+from search import dish_index
 
 
 load_dotenv()
 
 
+logger = logging.getLogger(__name__)
+
+
 class Canteen(enum.Enum):
     """
     This enum contains all the canteens of the university
@@ -46,20 +60,23 @@ def build_daily_url(date: datetime.date, canteen: Canteen):
     @param date: The date of which you want to get the menu
     @param canteen: The canteen of which you want to get the menu
 
-    @return: The url of the daily menu of the specified canteen for the specified day
+    @return: The url of the daily menu of the specified canteen for the specified day,
+        on the site set by ERDIS_BASE_URL
     """
     month = str(date.month) if date.month > 9 else "0" + str(date.month)
     day = str(date.day) if date.day > 9 else "0" + str(date.day)
     canteen = str(canteen)
-    return "https://www.erdis.it/menu/Mensa_" + canteen + \
+    return os.getenv('ERDIS_BASE_URL', 'https://www.erdis.it/menu') + "/Mensa_" + canteen + \
         "/Menu_Del_Giorno_" + str(date.year) + "_" + month + "_" + day + "_" + canteen + ".html"
 
 
-def sanitise(dirty_html):
+@functools.lru_cache(maxsize=None)
+def get_cleaner():
     """
-    Sanitises the html of the daily menu
+    Builds the html cleaner, lxml.html.clean is imported on first use since it is slow to load
     """
-    cleaner = Cleaner(page_structure=True,
+    from lxml.html.clean import Cleaner
+    return Cleaner(page_structure=True,
                   meta=True,
                   embedded=True,
                   links=True,
@@ -78,16 +95,62 @@ def sanitise(dirty_html):
                   remove_tags=()
                 )
 
-    return cleaner.clean_html(dirty_html)
+
+def sanitise(dirty_html):
+    """
+    Sanitises the html of the daily menu
+    """
+    return get_cleaner().clean_html(dirty_html)
+
+
+def expand_rowspans(table) -> List[list]:
+    """
+    Walks the rows of a table once and expands the cells spanning more rows into a 2-D grid
+
+    @param table: The table to expand
+
+    @return: A list of rows, each one being the list of cells covering that row, column by column
+    """
+    grid = []
+    spanning = {}
+    for row in table.find_all('tr'):
+        cells = iter(row.find_all(['td', 'th'], recursive=False))
+        line = []
+        column = 0
+        cell = next(cells, None)
+        while cell is not None or any(index >= column for index in spanning):
+            if column in spanning:
+                spanning_cell, remaining = spanning[column]
+                line.append(spanning_cell)
+                if remaining > 1:
+                    spanning[column] = (spanning_cell, remaining - 1)
+                else:
+                    del spanning[column]
+            elif cell is not None:
+                line.append(cell)
+                try:
+                    rowspan = int(cell.get('rowspan', 1))
+                except ValueError:
+                    rowspan = 1
+                if rowspan > 1:
+                    spanning[column] = (cell, rowspan - 1)
+                cell = next(cells, None)
+            else:
+                line.append(None)
+            column += 1
+        grid.append(line)
+    return grid
 
 
 def get_daily_menu(menu_table) -> Dict[str, Dict[str, List[str]]]:
     """
     Gets the daily menu from the html of the daily menu
-    """
-    full_turn_list = menu_table.select('tr>td')
-    full_turn_list = list(filter(lambda x: x.text in ['Pranzo', 'Cena'], full_turn_list))
 
+    The table has one row per dish, the first column holds the turn, the second one the course
+    and the third one the dish, turn and course cells span all the rows they refer to. Rows not
+    covered by the turn or course cells, like the later rows of the Frutta course whose label has
+    no rowspan, hold the dish only and belong to the last turn and course seen.
+    """
     out = {
         'Pranzo': {
             'Primo': [],
@@ -103,96 +166,24 @@ def get_daily_menu(menu_table) -> Dict[str, Dict[str, List[str]]]:
         }
     }
 
-    lunch_turn = list(filter(lambda x: x.text in ['Pranzo'], full_turn_list))[0]
-    selector = 'tr:nth-child(-n+ ' + lunch_turn['rowspan'] + ')'
-    lunch_turn_rows = menu_table.select(selector)[1:]
-
-    for row in lunch_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Primo'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            first_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(-n+ ' + str(int(first_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Pranzo']['Primo'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    for row in lunch_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Secondo'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            second_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(n+ ' + str(int(first_turn['rowspan'])+1) + '):nth-child(-n+' + str(int(first_turn['rowspan']) + int(second_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Pranzo']['Secondo'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    for row in lunch_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Contorno'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            third_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(n+ ' + str(int(first_turn['rowspan']) + int(second_turn['rowspan']) + 1) + \
-        '):nth-child(-n+' + str(int(first_turn['rowspan']) + int(second_turn['rowspan']) + int(third_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Pranzo']['Contorno'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    selector = 'tr:nth-child(n+ ' + str(int(first_turn['rowspan']) + int(second_turn['rowspan']) + int(third_turn['rowspan']) + 1) + \
-        '):nth-child(-n+' + str(int(lunch_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Pranzo']['Frutta'].append(list(filter(lambda x: x.text != "Frutta", row.select('td:not([rowspan])')))[0].text.lower())
-
-
-    dinner_turn = list(filter(lambda x: x.text in ['Cena'], full_turn_list))[0]
-    selector = 'tr:nth-child(n+ ' + str(int(lunch_turn['rowspan']) + 2) + '):nth-child(-n+' + str(int(lunch_turn['rowspan']) + int(dinner_turn['rowspan']) + 1) + ')'
-    dinner_turn_rows = menu_table.select(selector)
-    for row in dinner_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Primo'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            first_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(n+ ' + str(int(lunch_turn['rowspan']) + 2) + \
-        '):nth-child(-n+ ' + str(int(lunch_turn['rowspan']) + int(first_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Cena']['Primo'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    for row in dinner_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Secondo'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            second_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(n+ ' + str(int(lunch_turn['rowspan']) + int(first_turn['rowspan']) + 2) + \
-        '):nth-child(-n+ ' + str( int(lunch_turn['rowspan']) + int(first_turn['rowspan']) + int(second_turn['rowspan']) + 1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Cena']['Secondo'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    for row in dinner_turn_rows:
-        lst = list(filter(lambda x: x.text in ['Contorno'], row.select('td[rowspan]')))
-        if len(lst)>0:
-            third_turn = lst[0]
-            break
-
-    selector = 'tr:nth-child(n+ ' + str(int(lunch_turn['rowspan'])+int(first_turn['rowspan']) + int(second_turn['rowspan']) + 2) + \
-        '):nth-child(-n+ ' + str(int(lunch_turn['rowspan']) + int(first_turn['rowspan']) + int(second_turn['rowspan'])+ int(third_turn['rowspan']) + 1) + ')'
-    turn_rows = menu_table.select(selector)[1:]
-    for row in turn_rows:
-        out['Cena']['Contorno'].append(row.select('td:not([rowspan])')[0].text.lower())
-
-    selector = 'tr:nth-child(n+ ' + str(int(lunch_turn['rowspan']) + int(first_turn['rowspan']) + int(second_turn['rowspan']) + int(third_turn['rowspan']) + 2) + \
-        '):nth-child(-n+' + str(int(lunch_turn['rowspan']) + int(dinner_turn['rowspan'])+1) + ')'
-    turn_rows = menu_table.select(selector)
-
-    for row in turn_rows:
-        out['Cena']['Frutta'].append(list(filter(lambda x: x.text != "Frutta", row.select('td:not([rowspan])')))[0].text.lower())
+    turn = course = None
+    for line in expand_rowspans(menu_table):
+        cells = [cell for cell in line if cell is not None]
+        if len(cells) >= 3:
+            turn, course, dish = cells[0].text.strip(), cells[1].text.strip(), cells[2]
+        elif len(cells) == 2:
+            label, dish = cells[0].text.strip(), cells[1]
+            if label in out:
+                turn = label
+            else:
+                course = label
+        elif len(cells) == 1:
+            dish = cells[0]
+        else:
+            continue
+        if turn not in out or course is None:
+            continue
+        out[turn].setdefault(course, []).append(dish.text.lower())
 
     return out
 
@@ -233,73 +224,340 @@ def parse_menu(html) -> Dict[str, Dict[str, List[str]]]:
     """
     Parses the html of the daily menu and returns a dictionary with the menu
     """
-    html_content = sanitise(html)
-    soup = BeautifulSoup(html_content, 'html.parser')
-    tables = soup.select('table#menu')
-    if len(tables) < 2:
-        return None, None
-    time_table = tables[0]
-    menu_table = tables[1]
-
-    daily_time = get_daily_time(time_table)
-    daily_menu = get_daily_menu(menu_table)
+    from bs4 import BeautifulSoup
+    with metrics.timed('menu_refresh_stage_seconds', stage='sanitise'):
+        html_content = sanitise(html)
+    with metrics.timed('menu_refresh_stage_seconds', stage='parse'):
+        soup = BeautifulSoup(html_content, 'html.parser')
+        tables = soup.select('table#menu')
+        if len(tables) < 2:
+            return None, None
+        time_table = tables[0]
+        menu_table = tables[1]
+
+        daily_time = get_daily_time(time_table)
+        daily_menu = get_daily_menu(menu_table)
     return daily_menu, daily_time
 
 
+def empty_menu() -> Dict[str, Dict[str, List[str]]]:
+    """
+    Returns the menu saved when a canteen page has no menu tables
+    """
+    return {
+        'Pranzo':{
+            'Primo':[],
+            'Secondo':[],
+            'Contorno':[],
+            'Frutta':[]
+        },
+        'Cena':{
+            'Primo':[],
+            'Secondo':[],
+            'Contorno':[],
+            'Frutta':[]
+        }
+    }
+
+
+def empty_time() -> Dict[str, Dict[str, object]]:
+    """
+    Returns the timetable saved when a canteen page has no menu tables
+    """
+    return {
+        'Pranzo':{
+            'IsOpen': False,
+            'OpenTime': '-',
+            'CloseTime': '-'
+        },
+        'Cena':{
+            'IsOpen': False,
+            'OpenTime': '-',
+            'CloseTime': '-'
+        }
+    }
+
+
 def save_menu_to_db(menu: Dict[str, Dict[str, List[str]]], time: Dict[str, str], canteen: Canteen):
     """
     Saves the menu and timetable to the database
     """
-    mongo_client = db.open_connection()
-    data_base = db.get_data_base(mongo_client=mongo_client)
-    collection = data_base[os.getenv('DB_MENU_COLLECTION')]
-    collection.find_one_and_delete({'canteen': canteen.value.lower()})
-    collection.insert_one({'canteen': canteen.value.lower(), 'menu': menu, 'time': time, 'date': datetime.date.today().isoformat()})
-    db.close_connection(mongo_client)
+    save_menus_to_db([(canteen, menu, time)])
+
+
+def save_menus_to_db(results: List[Tuple[Canteen, Dict[str, Dict[str, List[str]]], Dict[str, str]]]):
+    """
+    Saves the menus and timetables of many canteens to the database in a single batch
+
+    Menus whose content is the same as the one already saved today are not written again,
+    the changes of the menus already saved today are notified to the change listeners.
+
+    @param results: List of (canteen, menu, time) tuples
+    """
+    if len(results) <= 0:
+        return
+    today = datetime.date.today().isoformat()
+    collection = db.get_menu_collection()
+    saved = {document['canteen']: document for document in dishes.decode_documents(collection.find(
+        {'canteen': {'$in': [canteen.value.lower() for canteen, _, _ in results]}},
+        {'_id': 0, 'canteen': 1, 'date': 1, 'menu': 1, 'time': 1, 'content_hash': 1, 'format': 1}))}
+    changed = []
+    menu_changes = []
+    for canteen, menu, time in results:
+        new_hash = changes.content_hash(menu, time)
+        previous = saved.get(canteen.value.lower())
+        if previous is not None and previous['date'] == today:
+            if previous.get('content_hash', changes.content_hash(previous['menu'], previous['time'])) == new_hash:
+                continue
+            diff = changes.diff_menu(previous['menu'], previous['time'], menu, time)
+            if len(diff) > 0:
+                menu_changes.append(changes.MenuChange(today, canteen.value.lower(), diff))
+        changed.append((canteen, menu, time, new_hash))
+    metrics.increment('menu_saves_skipped_total', len(results) - len(changed))
+    if len(changed) <= 0:
+        logger.info("No menu changed, nothing to save")
+        return
+    with metrics.timed('menu_refresh_stage_seconds', stage='save'):
+        collection.bulk_write([ReplaceOne({'canteen': canteen.value.lower()},
+                                          {'canteen': canteen.value.lower(), 'date': today, 'content_hash': content_hash,
+                                           **dishes.encode_document(menu, time)},
+                                          upsert=True)
+                               for canteen, menu, time, content_hash in changed], ordered=False)
+        archive_menus_to_db([(today, canteen, menu, time) for canteen, menu, time, _ in changed])
+    menu_cache.invalidate(today, [canteen.value.lower() for canteen, _, _, _ in changed])
+    changes.notify(menu_changes)
+
+
+def archive_menus_to_db(results: List[Tuple[str, Canteen, Dict[str, Dict[str, List[str]]], Dict[str, str]]]):
+    """
+    Saves the menus and timetables to the archive, replacing the ones saved for the same date and canteen,
+    and adds their dishes to the search index
+
+    @param results: List of (date, canteen, menu, time) tuples, date in iso format
+    """
+    if len(results) <= 0:
+        return
+    db.get_archive_collection().bulk_write([
+        ReplaceOne({'date': date, 'canteen': canteen.value.lower()},
+                   {'date': date, 'canteen': canteen.value.lower(), **dishes.encode_document(menu, time)},
+                   upsert=True)
+        for date, canteen, menu, time in results], ordered=False)
+    for date, canteen, menu, _ in results:
+        dish_index.add_menu(date, canteen.value.lower(), menu)
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """
+    Creates an http session whose connection pool is shared by all the fetch workers
+
+    @param pool_size: The number of connections kept open towards the erdis website
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_canteen(session: requests.Session, canteen: Canteen, date: datetime.date, timeout: float,
+                  force: bool = False, offline: bool = False):
+    """
+    Downloads and parses the daily menu of a single canteen
+
+    @param session: The http session used to download the page
+    @param canteen: The canteen of which you want to get the menu
+    @param date: The date of which you want to get the menu
+    @param timeout: The maximum number of seconds spent downloading the page
+    @param force: If True the page is parsed even if it did not change since it was last saved
+    @param offline: If True the page is read from the page cache only
+
+    @return: A (canteen, menu, time, url, content_hash) tuple, menu and time are None if the page
+        did not change since it was last saved, the result is None if the page could not be downloaded
+    """
+    url = build_daily_url(date, canteen)
+    with metrics.timed('menu_refresh_stage_seconds', stage='fetch'):
+        page = fetch(session, url, timeout, page_cache, offline=offline)
+    if page.status_code != 200:
+        logger.error("Error: %s for %s", page.status_code, canteen)
+        return None
+    if not page.changed and not force:
+        return canteen, None, None, url, page.content_hash
+    logger.info(f"Getting info on canteen: {canteen}")
+    menu, time = parse_menu(page.body.decode('utf-8'))
+    if menu is None or time is None:
+        menu, time = empty_menu(), empty_time()
+    return canteen, menu, time, url, page.content_hash
+
+
+class MenuReadiness:
+    """
+    Tells whether the menus of a day are in the database, so that jobs can wait for them
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._date = None
+
+    def set(self, date: str):
+        """
+        Mark the menus of the specified day as available
+        """
+        with self._condition:
+            self._date = date
+            self._condition.notify_all()
 
+    def wait(self, date: str, timeout: float = None) -> bool:
+        """
+        Wait until the menus of the specified day are available
 
-def init_menu():
+        @return: True if the menus are available, False if the timeout expired
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._date == date, timeout)
+
+
+menu_readiness = MenuReadiness()
+
+
+@metrics.timed_function('menu_refresh_seconds')
+def init_menu(max_workers: int = None, deadline: float = None, force: bool = False, offline: bool = False):
     """
     Module main function, does all the work
+
+    All the canteens are downloaded and parsed concurrently, then saved in a single batch.
+    Pages that did not change since they were last saved are neither parsed nor saved again.
+
+    @param max_workers: The maximum number of canteens fetched at the same time,
+        defaults to the MENU_FETCH_WORKERS environment variable
+    @param deadline: The maximum number of seconds to wait for each canteen,
+        defaults to the MENU_FETCH_DEADLINE environment variable
+    @param force: If True unchanged pages are parsed and saved as well
+    @param offline: If True the menus are rebuilt from the page cache, without any request
+
+    @return: The number of canteens whose menu is up to date in the database
     """
-    for canteen in Canteen:
-        url = build_daily_url(datetime.date.today(), canteen)
-        headers = {'Accept-Encoding': 'identity'}
-        request = requests.get(url, headers=headers, timeout=60)
-        if request.status_code == 200:
-            from bot import logger
-            logger.info(f"Getting info on canteen: {canteen}")
-            menu, time = parse_menu(request.content.decode('utf-8'))
-            if menu is not None and time is not None:
-                save_menu_to_db(menu, time, canteen)
-            else:
-                menu = {
-                    'Pranzo':{
-                        'Primo':[],
-                        'Secondo':[],
-                        'Contorno':[],
-                        'Frutta':[]
-                    }, 
-                    'Cena':{
-                        'Primo':[],
-                        'Secondo':[],
-                        'Contorno':[],
-                        'Frutta':[]
-                    }
-                }
-                time = {
-                    'Pranzo':{
-                        'IsOpen': False,
-                        'OpenTime': '-',
-                        'CloseTime': '-'
-                    },
-                    'Cena':{
-                        'IsOpen': False,
-                        'OpenTime': '-',
-                        'CloseTime': '-'
-                    }
-                }
-                save_menu_to_db(menu, time, canteen)
+    if max_workers is None:
+        max_workers = int(os.getenv('MENU_FETCH_WORKERS', str(len(Canteen))))
+    if deadline is None:
+        deadline = float(os.getenv('MENU_FETCH_DEADLINE', '60'))
+    max_workers = max(1, min(max_workers, len(Canteen)))
+    today = datetime.date.today()
+    results = []
+    with create_session(max_workers) as session:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='menu-fetch')
+        futures = {executor.submit(fetch_canteen, session, canteen, today, deadline, force, offline): canteen
+                   for canteen in Canteen}
+        # every canteen gets its own deadline, measured from the moment a worker picks it up,
+        # so the overall wait is bounded by the number of rounds the pool needs
+        rounds = -(-len(futures) // max_workers)
+        done, not_done = concurrent.futures.wait(futures, timeout=deadline * rounds)
+        for future in not_done:
+            future.cancel()
+            logger.error("Error: deadline exceeded for %s", futures[future])
+        # the fetches still running stop at their own deadline, the session is closed only once they are over
+        executor.shutdown(wait=True)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception:
+                # a canteen failing to download or parse must not prevent the others from being saved
+                logger.exception("Error while getting the menu of %s", futures[future])
+                continue
+            if result is not None:
+                results.append(result)
+    results.sort(key=lambda result: list(Canteen).index(result[0]))
+    changed = [result for result in results if result[1] is not None]
+    save_menus_to_db([(canteen, menu, time) for canteen, menu, time, _, _ in changed])
+    for _, _, _, url, content_hash in changed:
+        page_cache.mark_saved(url, content_hash)
+    page_cache.prune(float(os.getenv('MENU_PAGE_CACHE_MAX_AGE', str(7 * 24 * 60 * 60))))
+    if len(results) > 0:
+        menu_readiness.set(today.isoformat())
+    return len(results)
+
+
+def rebuild_menu_from_cache():
+    """
+    Rebuilds today's menus from the page cache, without any network request
 
-        else:
-            print("Error: " + str(request.status_code) + " for " + canteen)
+    @return: The number of canteens saved to the database
+    """
+    return init_menu(force=True, offline=True)
+
+
+class RefreshCoordinator:
+    """
+    Makes sure a single menu refresh runs at a time
+
+    Callers arriving while a refresh is running wait for its outcome instead of starting their own,
+    a failed refresh is retried with exponential backoff and, once all the attempts are exhausted,
+    further refreshes are refused until the cooldown expires.
+    """
+    def __init__(self, retries: int, backoff: float, cooldown: float):
+        self.retries = retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._in_flight = None
+        self._last_result = False
+        self._failed_at = None
+
+    def refresh(self, timeout: float = None, force: bool = False) -> bool:
+        """
+        Refresh today's menu, or wait for the refresh already running
+
+        @param timeout: The maximum number of seconds to wait for a refresh started by someone else
+        @param force: If True unchanged pages are parsed and saved as well
+
+        @return: True if the menu has been saved, False otherwise
+        """
+        with self._lock:
+            if self._failed_at is not None and time_module.monotonic() - self._failed_at < self.cooldown:
+                return False
+            in_flight = self._in_flight
+            if in_flight is None:
+                self._in_flight = threading.Event()
+        if in_flight is not None:
+            if not in_flight.wait(timeout):
+                return False
+            return self._last_result
+        result = False
+        try:
+            result = self._refresh_with_retry(force)
+        finally:
+            with self._lock:
+                self._last_result = result
+                self._failed_at = None if result else time_module.monotonic()
+                self._in_flight.set()
+                self._in_flight = None
+        return result
+
+    def _refresh_with_retry(self, force: bool) -> bool:
+        for attempt in range(self.retries):
+            try:
+                if init_menu(force=force) > 0:
+                    return True
+            except Exception as exception:
+                logger.error("Error: menu refresh failed: %s", exception)
+            if attempt < self.retries - 1:
+                time_module.sleep(self.backoff * 2 ** attempt)
+        return False
+
+
+refresh_coordinator = RefreshCoordinator(retries=int(os.getenv('MENU_REFRESH_RETRIES', '3')),
+                                         backoff=float(os.getenv('MENU_REFRESH_BACKOFF', '5')),
+                                         cooldown=float(os.getenv('MENU_REFRESH_COOLDOWN', '300')))
+
+
+def refresh_menu(timeout: float = None, force: bool = False) -> bool:
+    """
+    Refresh today's menu, at most one refresh runs at a time
+
+    @param timeout: The maximum number of seconds to wait for a refresh started by someone else,
+        defaults to the MENU_REFRESH_WAIT environment variable
+    @param force: If True unchanged pages are parsed and saved as well
+
+    @return: True if the menu has been saved, False otherwise
+    """
+    if timeout is None:
+        timeout = float(os.getenv('MENU_REFRESH_WAIT', '300'))
+    return refresh_coordinator.refresh(timeout, force)
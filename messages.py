@@ -0,0 +1,62 @@
+"""
+This module packs the rendered blocks of text into as few Telegram messages as possible.
+
+Blocks are rendered as html where every tag is opened and closed on the same line,
+so splitting between blocks or between lines never breaks a tag.
+"""
+import re
+from typing import List
+
+
+MESSAGE_LIMIT = 4096
+
+TAG = re.compile(r'<[^>]*>')
+
+
+def split_block(block: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Split a block longer than the limit on line boundaries
+
+    A single line longer than the limit is stripped of its tags and cut in pieces.
+    """
+    parts = []
+    current = ''
+    for line in block.splitlines(keepends=True):
+        if len(line) > limit:
+            line = TAG.sub('', line)
+            while len(line) > limit:
+                if len(current) > 0:
+                    parts.append(current)
+                    current = ''
+                parts.append(line[:limit])
+                line = line[limit:]
+        if len(current) > 0 and len(current) + len(line) > limit:
+            parts.append(current)
+            current = ''
+        current += line
+    if len(current) > 0:
+        parts.append(current)
+    return parts
+
+
+def pack_messages(blocks: List[str], limit: int = MESSAGE_LIMIT, separator: str = '\n') -> List[str]:
+    """
+    Join the blocks into as few messages as possible, each one at most limit characters long
+
+    @param blocks: The rendered blocks, in the order they must be sent
+    @param limit: The maximum length of a message
+    @param separator: The text put between two blocks of the same message
+
+    @return: The messages to send
+    """
+    messages = []
+    current = ''
+    for block in blocks:
+        for part in split_block(block, limit) if len(block) > limit else [block]:
+            if len(current) > 0 and len(current) + len(separator) + len(part) > limit:
+                messages.append(current)
+                current = ''
+            current += separator + part if len(current) > 0 else part
+    if len(current) > 0:
+        messages.append(current)
+    return messages
@@ -0,0 +1,243 @@
+"""
+This module contains the in-process metrics: counters and latency histograms of the hot paths,
+exposed in the Prometheus text format and summarised by the /stats command.
+"""
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, the latest observations are kept to compute percentiles
+    """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, reservoir_size: int = 1024):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.reservoir = collections.deque(maxlen=reservoir_size)
+
+    def observe(self, value: float):
+        """
+        Record an observation
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.reservoir.append(value)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Get the specified percentile of the latest observations
+        """
+        if len(self.reservoir) <= 0:
+            return 0.0
+        values = sorted(self.reservoir)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, tuple], float] = collections.defaultdict(float)
+_histograms: Dict[Tuple[str, tuple], Histogram] = {}
+_gauges: Dict[Tuple[str, tuple], float] = {}
+_collectors: List[Tuple[str, Callable[[], Dict[str, float]]]] = []
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name: str, amount: float = 1, **labels):
+    """
+    Increment a counter
+    """
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Set the value of a gauge
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels):
+    """
+    Record an observation in a histogram
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(value)
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    """
+    Record the duration of the enclosed block, in seconds, failures are counted in name_errors_total
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment(name + '_errors_total', **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed_function(name: str, **labels):
+    """
+    Decorator recording the duration of every call of the decorated function
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_collector(prefix: str, collector: Callable[[], Dict[str, float]]):
+    """
+    Register a function whose values are exported as gauges named prefix_key
+    """
+    with _lock:
+        _collectors.append((prefix, collector))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if len(labels) <= 0:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render_prometheus() -> str:
+    """
+    Get all the metrics in the Prometheus text format
+    """
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+        gauges = sorted(_gauges.items())
+        collectors = list(_collectors)
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), histogram in histograms:
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bucket, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{_format_labels(labels, (("le", bucket),))} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {histogram.count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+    for (name, labels), value in gauges:
+        if name not in typed:
+            lines.append(f'# TYPE {name} gauge')
+            typed.add(name)
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for prefix, collector in collectors:
+        try:
+            values = collector()
+        except Exception as exception:
+            logger.warning("Cannot collect %s metrics: %s", prefix, exception)
+            continue
+        for key, value in values.items():
+            lines.append(f'# TYPE {prefix}_{key} gauge')
+            lines.append(f'{prefix}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def histogram_stats(name: str) -> Dict[str, dict]:
+    """
+    Get the count and the p50, p95 and p99, in seconds, of every histogram with the specified name
+
+    @return: The stats keyed by the comma separated label values
+    """
+    with _lock:
+        return {','.join(str(value) for _, value in labels): {
+                    'count': histogram.count,
+                    'p50': histogram.percentile(50),
+                    'p95': histogram.percentile(95),
+                    'p99': histogram.percentile(99)
+                } for (histogram_name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0])
+                if histogram_name == name}
+
+
+def summary() -> List[str]:
+    """
+    Get one line per histogram with its count and its p50, p95 and p99 in milliseconds
+    """
+    with _lock:
+        histograms = sorted(_histograms.items(), key=lambda item: item[0])
+        lines = []
+        for (name, labels), histogram in histograms:
+            label_text = ','.join(str(value) for _, value in labels)
+            lines.append(f'{name}[{label_text}] n={histogram.count} '
+                         f'p50={histogram.percentile(50) * 1000:.0f}ms '
+                         f'p95={histogram.percentile(95) * 1000:.0f}ms '
+                         f'p99={histogram.percentile(99) * 1000:.0f}ms')
+    return lines
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics in the Prometheus text format
+    """
+    def do_GET(self):
+        """
+        Reply with the metrics
+        """
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_metrics_server(listen: str, port: int) -> ThreadingHTTPServer:
+    """
+    Start serving the metrics on http://listen:port/metrics in a background thread
+    """
+    server = ThreadingHTTPServer((listen, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Metrics available on %s:%d/metrics", listen, port)
+    return server
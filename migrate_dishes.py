@@ -0,0 +1,63 @@
+"""
+Migration of the menu documents to the compact dish-interned format.
+
+The documents of the menu and archive collections still storing the dish names are rewritten with
+the dish ids and the fixed-shape timetable. Documents already migrated are skipped, so the migration
+can be interrupted and run again.
+
+Usage:
+    python migrate_dishes.py [--batch-size N]
+"""
+import argparse
+import logging
+
+from pymongo import UpdateOne
+
+import data_base as db
+import dishes
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_collection(collection, batch_size: int) -> int:
+    """
+    Rewrite the documents of a collection still in the previous format
+
+    @return: The number of documents migrated
+    """
+    migrated = 0
+    operations = []
+    for document in collection.find({'format': {'$ne': dishes.STORAGE_FORMAT}}, {'_id': 1, 'menu': 1, 'time': 1}):
+        operations.append(UpdateOne({'_id': document['_id']},
+                                    {'$set': dishes.encode_document(document['menu'], document['time'])}))
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+            logger.info("Migrated %d documents of %s", migrated, collection.name)
+    if len(operations) > 0:
+        collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+    return migrated
+
+
+def main():
+    """
+    Migration main function
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Migrate the menu documents to the compact dish-interned format')
+    parser.add_argument('--batch-size', type=int, default=500, help='documents written at once')
+    arguments = parser.parse_args()
+
+    db.ensure_schema()
+    dishes.dish_dictionary.load()
+    for collection in (db.get_menu_collection(), db.get_archive_collection()):
+        logger.info("Migrated %d documents of %s", migrate_collection(collection, arguments.batch_size), collection.name)
+    logger.info("Dish dictionary: %s", dishes.dish_dictionary.stats())
+    db.close_connection()
+
+
+if __name__ == '__main__':
+    main()
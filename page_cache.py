@@ -0,0 +1,186 @@
+"""
+This module contains the on-disk cache of the downloaded menu pages.
+
+Each page is stored with its ETag and Last-Modified headers, so that following downloads are
+conditional requests, and with the hash of its content, so that unchanged pages are not parsed again.
+"""
+import collections
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+import requests
+
+
+FetchResult = collections.namedtuple('FetchResult', ['status_code', 'body', 'content_hash', 'changed'])
+
+
+class PageCache:
+    """
+    Raw html of the menu pages, keyed by url
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._lock = threading.Lock()
+
+    def _paths(self, url: str):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key + '.html'), os.path.join(self.folder, key + '.json')
+
+    def load(self, url: str):
+        """
+        Get the cached body and metadata of the specified url
+
+        @return: A (body, metadata) couple, body is None if the page is not cached
+        """
+        body_path, meta_path = self._paths(url)
+        with self._lock:
+            try:
+                with open(meta_path, encoding='utf-8') as meta_file:
+                    meta = json.load(meta_file)
+                with open(body_path, 'rb') as body_file:
+                    return body_file.read(), meta
+            except (OSError, ValueError):
+                return None, {}
+
+    def store(self, url: str, body: bytes, meta: dict):
+        """
+        Store the body and metadata of the specified url
+        """
+        body_path, meta_path = self._paths(url)
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(body_path, 'wb') as body_file:
+                body_file.write(body)
+            with open(meta_path, 'w', encoding='utf-8') as meta_file:
+                json.dump(meta, meta_file)
+
+    def mark_saved(self, url: str, content_hash: str):
+        """
+        Remember that the page with the specified hash has been parsed and saved to the database
+        """
+        body, meta = self.load(url)
+        if body is None or meta.get('hash') != content_hash:
+            return
+        meta['saved_hash'] = content_hash
+        self.store(url, body, meta)
+
+    def prune(self, max_age: float):
+        """
+        Delete the pages downloaded more than max_age seconds ago
+        """
+        if not os.path.isdir(self.folder):
+            return
+        limit = time.time() - max_age
+        with self._lock:
+            for file_name in os.listdir(self.folder):
+                path = os.path.join(self.folder, file_name)
+                try:
+                    if os.path.getmtime(path) < limit:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+
+def read_body(response: requests.Response, deadline: float) -> bytes:
+    """
+    Reads the body of a streamed response, giving up when the deadline expires
+
+    The socket timeout only bounds each read, so a page sent a few bytes at a time would never time out,
+    a timer shuts the connection down when the deadline expires instead.
+
+    @param deadline: The time.monotonic() value after which the download is abandoned
+
+    @raise requests.Timeout: If the body is still being received when the deadline expires
+    """
+    expired = threading.Event()
+
+    def abort():
+        expired.set()
+        try:
+            # shutting down a duplicate of the descriptor stops the connection the response is read from
+            with socket.fromfd(response.raw.fileno(), socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError):
+            pass
+
+    timer = threading.Timer(max(0.0, deadline - time.monotonic()), abort)
+    timer.daemon = True
+    timer.start()
+    try:
+        with response:
+            body = response.content
+    except requests.RequestException:
+        if expired.is_set():
+            raise requests.Timeout(f'Deadline exceeded while reading {response.url}')
+        raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        # the shut down connection may look like the end of a shorter body
+        raise requests.Timeout(f'Deadline exceeded while reading {response.url}')
+    return body
+
+
+def fetch(session: requests.Session, url: str, timeout: float, cache: PageCache, offline: bool = False) -> FetchResult:
+    """
+    Downloads a page, sending a conditional request when the page is already cached
+
+    Pages are requested with gzip/deflate compression, when the server answers 304 or the content
+    hash matches the one last saved to the database the page is reported as not changed.
+    If the server cannot be reached the cached page, if any, is returned instead.
+
+    @param session: The http session used to download the page
+    @param url: The url of the page
+    @param timeout: The maximum number of seconds spent downloading the page, body included
+    @param cache: The cache where the page is stored
+    @param offline: If True the page is read from the cache only, without any request
+
+    @return: The status code, the body and its hash, and whether it changed since it was last saved
+    """
+    cached_body, meta = cache.load(url)
+    if offline:
+        if cached_body is None:
+            return FetchResult(404, None, None, False)
+        return FetchResult(200, cached_body, meta['hash'], meta['hash'] != meta.get('saved_hash'))
+
+    headers = {}
+    if cached_body is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    deadline = time.monotonic() + timeout
+    try:
+        response = session.get(url, headers=headers, timeout=timeout, stream=True)
+        if response.status_code != 200:
+            response.close()
+        else:
+            body = read_body(response, deadline)
+    except requests.RequestException:
+        if cached_body is None:
+            raise
+        return FetchResult(200, cached_body, meta['hash'], meta['hash'] != meta.get('saved_hash'))
+
+    if response.status_code == 304 and cached_body is not None:
+        return FetchResult(200, cached_body, meta['hash'], meta['hash'] != meta.get('saved_hash'))
+    if response.status_code != 200:
+        return FetchResult(response.status_code, None, None, False)
+
+    content_hash = hashlib.sha256(body).hexdigest()
+    new_meta = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': content_hash
+    }
+    if meta.get('saved_hash') == content_hash:
+        new_meta['saved_hash'] = content_hash
+    cache.store(url, body, new_meta)
+    return FetchResult(200, body, content_hash, content_hash != new_meta.get('saved_hash'))
+
+
+page_cache = PageCache(os.getenv('MENU_PAGE_CACHE_FOLDER', '.page_cache'))
@@ -0,0 +1,158 @@
+"""
+This module contains the in-memory inverted index used by /search to find the days a dish is served.
+
+Dish names are split into normalised tokens, every token points to the (date, canteen, turn, course, dish)
+entries containing it. Tokens are also kept sorted, for prefix lookups, and indexed by their single
+character deletions, for lookups tolerating a typo.
+"""
+import bisect
+import collections
+import logging
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r'[a-z0-9]+')
+
+STOP_WORDS = frozenset(['a', 'ai', 'al', 'alla', 'alle', 'allo', 'agli', 'con', 'da', 'del', 'della', 'delle', 'dei',
+                        'degli', 'di', 'e', 'ed', 'il', 'in', 'la', 'le', 'lo', 'gli', 'i', 'su', 'sul', 'sulla'])
+
+FUZZY_MIN_LENGTH = 4
+
+
+class Entry(NamedTuple):
+    """
+    A dish served on a day, in a canteen, for a turn and a course
+    """
+    date: str
+    canteen: str
+    turn: str
+    course: str
+    dish: str
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split a text in lowercase tokens without accents, stop words are dropped
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(character for character in text if not unicodedata.combining(character))
+    return [token for token in WORD.findall(text) if token not in STOP_WORDS]
+
+
+def deletions(token: str) -> Set[str]:
+    """
+    Get the token and all the strings obtained deleting one of its characters
+    """
+    variants = {token}
+    if len(token) >= FUZZY_MIN_LENGTH:
+        variants.update(token[:index] + token[index + 1:] for index in range(len(token)))
+    return variants
+
+
+class DishIndex:
+    """
+    Inverted index of the dishes of every archived menu
+
+    Menus are added with add_menu whenever they are saved, adding again the menu of a date and canteen
+    replaces the previous one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings: Dict[str, Set[Entry]] = collections.defaultdict(set)
+        self._tokens: List[str] = []
+        self._deletions: Dict[str, Set[str]] = collections.defaultdict(set)
+        self._menus: Dict[Tuple[str, str], Set[Entry]] = {}
+        self.loaded = threading.Event()
+
+    def add_menu(self, date: str, canteen: str, menu: Dict[str, Dict[str, List[str]]]):
+        """
+        Index the dishes of a menu
+
+        @param date: The date of the menu, in iso format
+        @param canteen: The lowercase name of the canteen
+        @param menu: The parsed menu, dishes keyed by turn and course
+        """
+        entries = {Entry(date, canteen, turn, course, dish)
+                   for turn, courses in menu.items() for course, dishes in courses.items() for dish in dishes}
+        with self._lock:
+            for entry in self._menus.pop((date, canteen), set()):
+                for token in set(tokenize(entry.dish)):
+                    self._postings[token].discard(entry)
+            for entry in entries:
+                for token in set(tokenize(entry.dish)):
+                    if token not in self._postings:
+                        bisect.insort(self._tokens, token)
+                        for variant in deletions(token):
+                            self._deletions[variant].add(token)
+                    self._postings[token].add(entry)
+            self._menus[(date, canteen)] = entries
+
+    def load(self, documents: Iterable[dict]):
+        """
+        Index the menus of the specified documents, then mark the index as loaded
+        """
+        count = 0
+        for document in documents:
+            self.add_menu(document['date'], document['canteen'], document['menu'])
+            count += 1
+        self.loaded.set()
+        logger.info("Indexed %d menus, %s", count, self.stats())
+
+    def _prefix_tokens(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._tokens, prefix)
+        end = bisect.bisect_left(self._tokens, prefix + '\uffff')
+        return self._tokens[start:end]
+
+    def _fuzzy_tokens(self, token: str) -> Set[str]:
+        matches = set()
+        for variant in deletions(token):
+            matches.update(self._deletions.get(variant, ()))
+        return matches
+
+    def _lookup(self, token: str) -> Set[Entry]:
+        # prefix matches include the exact one, typos are only tried when nothing starts with the token
+        tokens = self._prefix_tokens(token) or self._fuzzy_tokens(token)
+        entries = set()
+        for match in tokens:
+            entries.update(self._postings.get(match, ()))
+        return entries
+
+    def search(self, query: str) -> List[Entry]:
+        """
+        Get the entries whose dish contains all the words of the query, each word can be a prefix or have a typo
+
+        @return: The matching entries, sorted by date, canteen, turn and course
+        """
+        tokens = tokenize(query)
+        if len(tokens) <= 0:
+            return []
+        with metrics.timed('search_seconds'):
+            with self._lock:
+                entries = None
+                for token in tokens:
+                    entries = self._lookup(token) if entries is None else entries & self._lookup(token)
+                    if len(entries) <= 0:
+                        break
+            return sorted(entries)
+
+    def stats(self) -> dict:
+        """
+        Get the size of the index
+        """
+        with self._lock:
+            return {
+                'menus': len(self._menus),
+                'tokens': len(self._tokens),
+                'entries': sum(len(entries) for entries in self._menus.values())
+            }
+
+
+dish_index = DishIndex()
+metrics.register_collector('dish_index', dish_index.stats)
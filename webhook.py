@@ -0,0 +1,117 @@
+"""
+This module contains the webhook server, an alternative to long polling.
+
+Telegram posts every update to the local endpoint, the request is authenticated through the
+X-Telegram-Bot-Api-Secret-Token header and the update is queued to the dispatcher.
+Recorded updates can be posted to the endpoint to test the bot offline, for example:
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -d @fixtures/updates/menu.json http://127.0.0.1:8443/telegram
+"""
+import hmac
+import json
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+from telegram.ext import Updater
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Receives the updates posted by Telegram
+    """
+    def _reply(self, status_code: int):
+        self.send_response(status_code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        """
+        Queue the posted update to the dispatcher
+        """
+        if self.path != self.server.url_path:
+            self._reply(404)
+            return
+        secret_token = self.server.secret_token
+        if secret_token and not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ''), secret_token):
+            logger.warning("Rejected webhook request with an invalid secret token from %s", self.client_address[0])
+            self._reply(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', '0'))
+            payload = json.loads(self.rfile.read(length))
+            if not isinstance(payload, dict):
+                raise ValueError(f'expected a json object, got {type(payload).__name__}')
+            update = Update.de_json(payload, self.server.bot)
+            if update is None:
+                raise ValueError('empty update')
+        except (ValueError, TypeError, KeyError, AttributeError) as exception:
+            # a json object which is not an update fails while being converted
+            logger.warning("Rejected malformed webhook request: %s", exception)
+            self._reply(400)
+            return
+        self.server.update_queue.put(update)
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Http server handling each webhook request in its own thread
+    """
+    daemon_threads = True
+
+    def __init__(self, address, updater: Updater, url_path: str, secret_token: str):
+        super().__init__(address, WebhookHandler)
+        self.bot = updater.bot
+        self.update_queue = updater.update_queue
+        self.url_path = url_path
+        self.secret_token = secret_token
+
+
+def run_webhook(updater: Updater, listen: str, port: int, url_path: str, secret_token: str,
+                webhook_url: str = None, max_connections: int = 40):
+    """
+    Serve the bot through a webhook until SIGINT, SIGTERM or SIGABRT is received
+
+    @param updater: The updater whose dispatcher and job queue handle the updates
+    @param listen: The address the http server listens on
+    @param port: The port the http server listens on
+    @param url_path: The path updates are posted to
+    @param secret_token: The token Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+    @param webhook_url: The public url of the endpoint, if set the webhook is registered on Telegram
+    @param max_connections: The maximum number of concurrent connections Telegram opens to the endpoint
+    """
+    if not secret_token:
+        logger.warning("No webhook secret token configured, every request will be accepted")
+    server = WebhookServer((listen, port), updater, url_path, secret_token)
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+    server_thread = threading.Thread(target=server.serve_forever, name='webhook')
+    server_thread.start()
+    if webhook_url:
+        updater.bot.set_webhook(url=webhook_url, secret_token=secret_token or None, max_connections=max_connections)
+    logger.info("Webhook listening on %s:%d%s", listen, port, url_path)
+
+    stop = threading.Event()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(stop_signal, lambda signum, frame: stop.set())
+    while not stop.wait(1):
+        pass
+
+    logger.info("Stopping webhook")
+    server.shutdown()
+    server.server_close()
+    server_thread.join()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher_thread.join()